@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+import os
+import sys
+import json
+import argparse
+import traceback
+import contextlib
+import multiprocessing
+import topo2exr
+import utils.geo
+import utils.misc as misc
+from timeit import default_timer as timer
+
+# cells of the morton order, one degree like the finest GMT tiling
+MORTON_CELL = 1.
+MORTON_BITS = 16
+
+def buildParser():
+    parser = argparse.ArgumentParser(
+        prog = sys.argv[0],
+        description = 'Render many jobs of topo2exr with the same processes, sharing drivers, caches and grids')
+    parser.add_argument('jobs_file', type=str, metavar="JOBS_FILE",
+        help="JSON list or JSONL of jobs. A job maps topo2exr long options to their values, "
+             "for instance {\"output\": \"out\", \"area\": [5, 45, 6, 46], \"size\": \"4m\", "
+             "\"layer\": [[\"gmt\", \"earth_relief\", \"int16\", \"height\", \"1\", \"tif\"]]}")
+    parser.add_argument('--keep-order', action='store_true',
+        help="Render jobs in the order of the file instead of grouping nearby areas")
+    parser.add_argument('--jobs', type=int, default=0,
+        help="Processes shared by every job, 0 uses every cpu. The jobs which do not give --jobs use them all, "
+             "their workers keep drivers, grids and caches from a job to the next. A job given fewer processes, "
+             "or limited by its --max-memory, renders with a pool of its own")
+    return parser
+
+def readJobs(path):
+    with open(path) as f:
+        content = f.read()
+    try:
+        jobs = json.loads(content)
+    except json.JSONDecodeError:
+        jobs = [json.loads(line) for line in content.splitlines() if line.strip()]
+    if isinstance(jobs, dict):
+        jobs = [jobs]
+    return jobs
+
+def jobToArgv(job):
+    argv = []
+    for key, value in job.items():
+        flag = f"--{key.replace('_', '-')}"
+        if value is None or value is False:
+            continue
+        if value is True:
+            argv.append(flag)
+        elif isinstance(value, list) and value and isinstance(value[0], list):
+            # repeated options such as --layer
+            for values in value:
+                argv += [flag, *map(str, values)]
+        elif isinstance(value, list):
+            argv += [flag, *map(str, value)]
+        else:
+            argv += [flag, str(value)]
+    return argv
+
+def mortonKey(bounds):
+    minx, miny, maxx, maxy = bounds
+    x = int(((minx + maxx) / 2 + 180) / MORTON_CELL)
+    y = int(((miny + maxy) / 2 + 90) / MORTON_CELL)
+    key = 0
+    for bit in range(MORTON_BITS):
+        key |= ((x >> bit) & 1) << (2 * bit)
+        key |= ((y >> bit) & 1) << (2 * bit + 1)
+    return key
+
+def scheduleJobs(jobs):
+    # nearby areas one after the other, so that the caches serve the following ones
+    def key(job):
+        try:
+            _, gps_bounds = utils.geo.deduceBoundsFromArgs(job.args, utils.geo.WGS84)
+            return mortonKey(gps_bounds.bounds)
+        except Exception:
+            return -1
+    return sorted(jobs, key=key)
+
+def runJob(job, pool=None, pool_jobs=1):
+    run = topo2exr.prepareRun(job.args)
+    if job.args.plan:
+        topo2exr.planRun(run, run.jobs)
+        return []
+    shared_pool = pool if run.jobs == pool_jobs else None
+    return topo2exr.render(run, run.jobs, job.args.order, job.args.resume, pool=shared_pool)
+
+def main(argv):
+    parser = buildParser()
+    args = parser.parse_args(argv[1:])
+    job_parser = topo2exr.buildParser()
+
+    pool_jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+
+    jobs = []
+    failed = []
+    all_jobs = readJobs(args.jobs_file)
+    for idx, job in enumerate(all_jobs, 1):
+        argv_job = jobToArgv(job)
+        try:
+            job_args = job_parser.parse_args(argv_job)
+        except SystemExit:
+            print(f"-- job {idx} is invalid : {' '.join(argv_job)}")
+            failed.append(idx)
+            continue
+        if 'jobs' not in job:
+            job_args.jobs = pool_jobs
+        jobs.append(misc.dotdict(idx=idx, args=job_args))
+    if not args.keep_order:
+        jobs = scheduleJobs(jobs)
+
+    with contextlib.ExitStack() as stack:
+        pool = None
+        if pool_jobs > 1:
+            # forked before any driver is built, the workers build theirs with their first job
+            pool = stack.enter_context(multiprocessing.Pool(
+                processes=pool_jobs,
+                initializer=topo2exr.initWorker,
+                initargs=(None, True)))
+        for count, job in enumerate(jobs, 1):
+            print(f"processing job {job.idx} ({count}/{len(jobs)}) into {job.args.output}")
+            start = timer()
+            try:
+                results = runJob(job, pool, pool_jobs)
+                if any(result.error is not None for result in results):
+                    failed.append(job.idx)
+            except Exception as e:
+                traceback.print_exception(e)
+                failed.append(job.idx)
+            print(f"-- job {job.idx} finished in {timer()-start:.2f}s")
+
+    print(f"{len(all_jobs) - len(failed)} jobs done, {len(failed)} failed")
+    if failed:
+        print(f"-- failed jobs : {', '.join(map(str, sorted(failed)))}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
 import utils.misc as misc
+import utils.profiling as profiling
 
 class RasterDriver(ABC):
     def __init__(self, option_type):
@@ -22,15 +23,22 @@ class RasterDriver(ABC):
         print(f'--   on bands {bands}')
         options = misc.capitalizeOptions(options, self.option_type)
         print(f'--   with options {options}')
-        self.renderToRaster(
-            dst_ds = dst_ds,
-            bands = bands,
-            shape_bounds = shape_bounds,
-            gps_bounds = gps_bounds,
-            key = key,
-            options = options)
+        with profiling.stage(f'driver.{self.name()}'):
+            self.renderToRaster(
+                dst_ds = dst_ds,
+                bands = bands,
+                shape_bounds = shape_bounds,
+                gps_bounds = gps_bounds,
+                key = key,
+                options = options)
         print(f'--   done')
 
+    def planToRaster(self, bounds, width, gps_bounds, key, options, crs=None):
+        return []
+
+    def sourcesForVirtual(self, bounds, width, gps_bounds, key, options, crs=None):
+        raise Exception(f"{self.name()} cannot produce virtual rasters")
+
     @abstractmethod
     def renderToRaster(self, *_):
         pass
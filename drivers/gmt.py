@@ -1,26 +1,24 @@
 import urllib
 import drivers.driver as driver
 import utils.misc as misc
-from utils.rasterio import warpmerge, temporarydataset, LOSSLESS_JPEG2000
+from utils.rasterio import warpmerge, temporarydataset, sharedMemoize, transcode, recordFootprint, LOSSLESS_JPEG2000
 import re
 import math
 from collections import defaultdict
 import os
 import utils.lru as lru
 from rasterio.crs import CRS
-from rasterio.warp import Resampling
+from rasterio.warp import Resampling, transform_bounds
 import rasterio as rio
 import warnings
 from tempfile import NamedTemporaryFile
 from utils.grid import GmtGrid
 from shapely import geometry, ops
-from utils.process import gdal_translate
 import utils.net
 import pprint
 import dotenv
 
 INDEX_FILE_NAME = "index.html"
-DATASET_EXTENSION = "jp2"
 GMT_DATABASE = "gmt_data_server.txt"
 class Gmt2Raster(driver.RasterDriver):
     def __init__(self):
@@ -34,7 +32,6 @@ class Gmt2Raster(driver.RasterDriver):
         print(f"-- done")
 
         self.overide_crs = CRS.from_epsg(4326)
-        self.force_retrieve_index_once = True
         self.root = os.environ.get('GMT_SERVER', utils.net.getBestGMTServer())
         print(f'--  fetching dataset {self.root}')
         self.database = self.getDatabase(f"{self.root}/{GMT_DATABASE}")
@@ -62,14 +59,14 @@ class Gmt2Raster(driver.RasterDriver):
         columns = ('dir', 'name', 'inc', 'reg', 'scl', 'off', 'size', 'tile', 'date', 'coverage', 'filler', 'cpt', 'remark')
         re_get_collection = re.compile('([^/]+)/$')
         retval = defaultdict(dict)
-        with open(self.getFile(gmt_server, force_retrieve=self.force_retrieve_index_once)) as gmt_description:
+        # the database expires according to the ttl of the gmt cache, GMT_CACHE_TTL
+        with open(self.getFile(gmt_server)) as gmt_description:
             for row in self.gmtDbDecode(gmt_description):
                 row_dict = {k:v for k,v in zip(columns, row)}
                 base = row_dict['dir']
                 inc = int(misc.str2Arcsec(row_dict['inc']))
                 collection = re_get_collection.search(base).group(1)
                 retval[collection][inc] = row_dict
-        self.force_retrieve_index_once = False
         return retval
 
     def retrieveFile(self, path, url, suffix, shall_fix, retrial=1):
@@ -80,8 +77,7 @@ class Gmt2Raster(driver.RasterDriver):
                 return True
             with NamedTemporaryFile(suffix=suffix) as src:
                 utils.net.fetchFromInternet(path=src.name, url=url, desc=os.path.basename(path))
-                gdal_translate(src.name, path, '-a_srs', self.overide_crs.to_string())
-                return True
+                return transcode(src.name, path, self.lru.cache_format, '-a_srs', self.overide_crs.to_string())
         except urllib.error.HTTPError as e:
             if retrial <= 0:
                 return False
@@ -93,7 +89,7 @@ class Gmt2Raster(driver.RasterDriver):
                 return self.retrieveFile(path, re.sub(is_p_dataset_re, '_g/', url), suffix, shall_fix, retrial - 1)
             return self.retrieveFile(path, url, suffix, shall_fix, retrial - 1)
 
-    def getFile(self, url, shall_open=None, force_retrieve=False):
+    def urlToCacheName(self, url):
         url_parsed = urllib.parse.urlsplit(url)
         url_path = url_parsed.path
         *folder, filename = url_path.split('/')
@@ -107,11 +103,20 @@ class Gmt2Raster(driver.RasterDriver):
         suffix = f'.{suffix}'
 
         if shall_fix:
-            filename = '.'.join(basefilename + [DATASET_EXTENSION])
+            filename = '.'.join(basefilename + [self.lru.cache_format])
 
         fn = os.path.join(*folder, filename)
+        return fn, suffix, shall_fix
+
+    def isCached(self, url):
+        fn, _, _ = self.urlToCacheName(url)
+        return self.lru.lookup(fn) is not None
+
+    def getFile(self, url, shall_open=None, force_retrieve=False, expected_size=0):
+        fn, suffix, shall_fix = self.urlToCacheName(url)
         return self.lru.retrieve(
             fn,
+            expected_size=expected_size,
             retrieve_func=(
                 lambda path, fn:
                     self.retrieveFile(path=path, url=url, suffix=suffix, shall_fix=shall_fix)),
@@ -142,18 +147,14 @@ class Gmt2Raster(driver.RasterDriver):
             print(f'--         found {len(retval)} files')
         return retval
 
-    def retrieveDataset(self, dataset, obj):
+    def listDataset(self, dataset, obj):
         tiling = int(dataset['tile'])
         dataset_url = self.getUrlDataset(dataset)
         if not tiling:
             print("--     Found an entire map. Stopping here")
-            url = dataset_url
-            path = self.getFile(url)
-            if not path:
-                raise Exception('Inconsistent GMT database. Please try different mirror')
-            return [path], geometry.Polygon()
+            return [(dataset_url, None)], geometry.Polygon()
 
-        success = []
+        found = []
         failed = []
         coordinates_to_filename = self.getCoordinates2Filename(dataset_url)
         if coordinates_to_filename is None:
@@ -164,44 +165,52 @@ class Gmt2Raster(driver.RasterDriver):
                 getgeometry=(),
                 getattribute='name'):
             print(bbox)
-            minlon, minlat, _, _ = bbox.bounds
             if key in coordinates_to_filename: 
                 fn = coordinates_to_filename[key]
-                url = urllib.parse.urljoin(dataset_url, fn)
-                path = self.getFile(url)
-                if not path:
-                    raise Exception('Inconsistent GMT database. Please try different mirror')
-                success.append(path)
+                found.append((urllib.parse.urljoin(dataset_url, fn), bbox))
             else:
                 failed.append(bbox)
         failed_shape = obj.intersection(ops.unary_union(failed))
+        return found, failed_shape
+
+    def retrieveDataset(self, dataset, obj):
+        found, failed_shape = self.listDataset(dataset, obj)
+        success = []
+        for url, _ in found:
+            path = self.getFile(url, expected_size=self.estimateFileSize(dataset))
+            if not path:
+                raise Exception('Inconsistent GMT database. Please try different mirror')
+            success.append(path)
         return success, failed_shape
 
+    def estimateFileSize(self, dataset):
+        try:
+            size = misc.str2ByteSize(dataset['size'])
+        except Exception:
+            return None
+        tiling = int(dataset['tile'])
+        if not tiling:
+            return size
+        # the size is for the whole dataset, spread it over the tiles of the earth
+        return size * tiling * tiling // (360 * 180)
+
     def getUrlDataset(self, dataset):
         dataset_base = urllib.parse.urljoin(self.root, dataset['dir'])
         dataset_url = urllib.parse.urljoin(dataset_base, dataset['name'])
         return dataset_url
 
-    def renderToRaster(
-        self,
-        dst_ds,
-        bands,
-        shape_bounds,
-        gps_bounds,
-        key,
-        options
-    ):
+    def iterDatasets(self, bounds, width, gps_bounds, key, crs=None):
         shape_bounds = gps_bounds
-        minx, miny, maxx, maxy = dst_ds.bounds
-        
-        warnings.warn('projection')
+        if crs is not None and not crs.is_geographic:
+            # the resolutions of the datasets are in arcsec, projected bounds are measured in degrees
+            bounds = transform_bounds(crs, self.overide_crs, *bounds)
+        minx, miny, maxx, maxy = bounds
+
         if maxx < minx:
             maxx += 360
-        resolution = ((maxx-minx)%360)/dst_ds.width*3600
+        resolution = ((maxx-minx)%360)/width*3600
         print(f'--   Requested resolution is {resolution:.1f} arcsec')
 
-        successful = []
-
         step2dataset = self.getStep2Dataset(key)
 
         stepidx = len(step2dataset) - 1
@@ -210,15 +219,60 @@ class Gmt2Raster(driver.RasterDriver):
                 stepidx = i
                 break
 
+        # coarser resolutions fill what the finer ones do not cover
         while stepidx < len(step2dataset) and not shape_bounds.is_empty:
             step, dataset = step2dataset[stepidx]
             print(f"--   Trying with resolution {dataset['inc']}")
-            s,shape_bounds = self.retrieveDataset(
+            found, shape_bounds = self.listDataset(
                 dataset=dataset,
                 obj=shape_bounds,
             )
-            successful += s
+            yield dataset, found
             stepidx += 1
+
+    def resolveSources(self, bounds, width, gps_bounds, key, crs=None):
+        successful = []
+        for dataset, found in self.iterDatasets(bounds, width, gps_bounds, key, crs):
+            for url, bbox in found:
+                path = self.getFile(url, expected_size=self.estimateFileSize(dataset))
+                if not path:
+                    raise Exception('Inconsistent GMT database. Please try different mirror')
+                if bbox is not None:
+                    # the grid already knows the footprint, warpmerge will not open the tile to filter it
+                    recordFootprint(path, bbox.bounds, self.overide_crs)
+                successful.append(path)
+        return successful
+
+    def planToRaster(self, bounds, width, gps_bounds, key, options, crs=None):
+        planned = []
+        for dataset, found in self.iterDatasets(bounds, width, gps_bounds, key, crs):
+            size = self.estimateFileSize(dataset)
+            for url, _ in found:
+                planned.append(misc.dotdict(
+                    source=url,
+                    resolution=dataset['inc'],
+                    cached=self.isCached(url),
+                    size=size))
+        return planned
+
+    def sourcesForVirtual(self, bounds, width, gps_bounds, key, options, crs=None):
+        return sharedMemoize(
+            ('gmt', key, tuple(bounds), width, gps_bounds.wkb),
+            lambda: self.resolveSources(bounds, width, gps_bounds, key, crs))
+
+    def renderToRaster(
+        self,
+        dst_ds,
+        bands,
+        shape_bounds,
+        gps_bounds,
+        key,
+        options
+    ):
+        # layers sharing the same key on the same tile reuse the resolved files
+        successful = sharedMemoize(
+            ('gmt', key, tuple(dst_ds.bounds), dst_ds.width, gps_bounds.wkb),
+            lambda: self.resolveSources(dst_ds.bounds, dst_ds.width, gps_bounds, key, dst_ds.crs))
         print(f'--   Warping')
 
         warnings.warn('deal with empty merge')
@@ -1,5 +1,6 @@
 from utils.rasterio import warpmerge
 import drivers.driver as driver
+import utils.misc as misc
 from rasterio.warp import Resampling
 
 class Raster2Raster(driver.RasterDriver):
@@ -7,6 +8,12 @@ class Raster2Raster(driver.RasterDriver):
         driver.RasterDriver.__init__(self, 'raster_layer')
         print(f"-- creating raster2raster driver")
 
+    def planToRaster(self, bounds, width, gps_bounds, key, options, crs=None):
+        return [misc.dotdict(source=key, resolution=None, cached=True, size=None)]
+
+    def sourcesForVirtual(self, bounds, width, gps_bounds, key, options, crs=None):
+        return [key]
+
     def renderToRaster(
         self,
         dst_ds,
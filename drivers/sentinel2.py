@@ -1,4 +1,3 @@
-from osgeo import gdal
 from datetime import datetime, timedelta
 import drivers.driver as driver
 import utils.misc as misc
@@ -3,14 +3,10 @@ from sentinel2.utils import BandEnum, Dataset
 from sentinel2.retriever import Sentinel2Retriever
 import utils.lru as lru
 from datetime import datetime
-from s2cloudless import S2PixelCloudDetector
 import numpy as np
 import rasterio as rio
 from rasterio.warp import reproject, Resampling, Affine
 import math
-from skimage import filters
-
-import matplotlib.pyplot as plt
 
 from timeit import default_timer as timer
 
@@ -39,6 +35,7 @@ class Sentinel2Cloudless(object):
         self.lru = lru.get('sentinel2CLD')
         self.dataset = Dataset.L1C
         self.resolution = resolution
+        from s2cloudless import S2PixelCloudDetector
         self.cloud_detector = S2PixelCloudDetector(
             threshold=0.4,
             average_over=math.ceil(AVERAGE_OVER/self.resolution),
@@ -113,6 +110,7 @@ class Sentinel2Cloudless(object):
         path = self.getCloudPrbPath(scene)
         with rio.open(path) as probability:
             clouds = probability.read(1, out_shape=shape, resampling=Resampling.bilinear)
+            from skimage import filters
             threshold = filters.threshold_otsu(clouds) if threshold is None else threshold
             return self.cloud_detector.get_mask_from_prob(clouds[np.newaxis,...], threshold=threshold)
 
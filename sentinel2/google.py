@@ -1,10 +1,12 @@
-from google.cloud import storage
 import dotenv
 import os
 import utils.misc as misc
 import sentinel2.utils as s2utils
-from tqdm.std import tqdm
 import base64
+import utils.rasterio
+import utils.lru
+
+JP2_EXTENSION = "jp2"
 
 dotenv.load_dotenv()
 
@@ -12,6 +14,7 @@ class GoogleStorageClient():
     client = None
     def __init__(self):
         if self.__class__.client is None:
+            from google.cloud import storage
             self.__class__.client = storage.Client(project=None)
     def __call__(self):
         return self.__class__.client
@@ -57,6 +60,7 @@ class GoogleStorage(object):
                 
         except OSError:
             start = 0
+        from tqdm.std import tqdm
         with open(linux_path, 'ab') as f:
             with tqdm.wrapattr(
                     f,
@@ -75,6 +79,10 @@ class GoogleStorage(object):
             linux_path=linux_path,
             retry=retry)
 
+    def blobSize(self, blob_path):
+        blob = self.bucket.get_blob(blob_path)
+        return 0 if blob is None else blob.size
+
     def isblobdownloaded(self, blob_path, linux_path):
         try:
             blob = self.bucket.get_blob(blob_path)
@@ -101,10 +109,28 @@ class GoogleStorageSentinel2(object):
                 blob_path,
                 retrieve_func=lambda linux_path, blob_path: self.getGoogleStorage(linux_path=linux_path, blob_path=blob_path),
                 force_retrieve_func=lambda linux_path, blob_path: not self.googlestorage.isblobdownloaded(linux_path=linux_path, blob_path=blob_path),
+                expected_size=lambda: self.googlestorage.blobSize(blob_path),
+                # an interrupted download continues from its partial file
+                resumable=True,
                 )
         except Exception as e:
             raise RetrievalError(f"Impossible to retrieve {blob_path} : {e}") from e
 
+    def getBand(self, blob_path, dataset):
+        lru = s2utils.getLRU(dataset)
+        if lru.cache_format == JP2_EXTENSION or not blob_path.endswith(f".{JP2_EXTENSION}"):
+            return self.get(blob_path, dataset=dataset)
+
+        def transcodeBand(path, fn):
+            # the jpeg2000 is pinned while transcoded, then evicted unless another scope or process uses it
+            with utils.lru.pinning():
+                jp2_path = self.get(blob_path, dataset=dataset)
+                if jp2_path is None or not utils.rasterio.transcode(jp2_path, path, lru.cache_format):
+                    return False
+            lru.evict(blob_path)
+            return True
+        return lru.retrieve(f"{blob_path}.{lru.cache_format}", retrieve_func=transcodeBand)
+
     def getBandPath(self, scene, suffix):
         dataset = s2misc.datasetFromScene(scene)
         tree = s2misc.xmlTreeMTDFromScene(scene, s2misc.getLRUPath(dataset))
@@ -129,7 +155,7 @@ class GoogleStorageSentinel2(object):
             if ds_path is None:
                 retval[band_resolution] = None
             else:
-                retval[band_resolution] = self.get(f"{path}/{ds_path}", dataset=dataset)
+                retval[band_resolution] = self.getBand(f"{path}/{ds_path}", dataset=dataset)
         return retval
 
     def __call__(self, *args, **kwargs):
@@ -1,4 +1,3 @@
-from sentinelsat import SentinelAPI, read_geojson, geojson_to_wkt
 import sentinel2.utils as s2utils
 import utils.misc as misc
 import os
@@ -24,6 +23,7 @@ class ScihubApi():
                 mandatory = "'" + "','".join(MANDATORY_ENV_DHUS) + "'"
                 raise Exception(f"{mandatory} variables *has* to be provided, either through environment variables"
                                 " or .env")
+            from sentinelsat import SentinelAPI
             self.__class__.api = SentinelAPI(os.environ[API_USER_NAME], os.environ[API_PASSWORD_NAME])
 
     @staticmethod
@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+import os
+import sys
+import math
+import argparse
+import threading
+import traceback
+import multiprocessing
+import collections
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from shapely import box
+from rasterio.crs import CRS
+from rasterio.io import MemoryFile
+from rasterio.drivers import raster_driver_extensions
+import topo2exr
+import utils.geo
+import utils.grid
+import utils.lru
+import utils.exr
+import utils.postprocess
+import utils.misc as misc
+from utils.rasterio import temporarydataset, sharedDatasets, performanceEnv, performanceProfile, applyCacheSize, str2PerformanceProfile, PERFORMANCE_PROFILES
+
+WEB_MERCATOR = CRS.from_epsg(3857)
+WEB_MERCATOR_EXTENT = 2 * math.pi * 6378137
+
+CONTENT_TYPES = {
+    'png' : 'image/png',
+    'jpg' : 'image/jpeg',
+    'jpeg' : 'image/jpeg',
+    'webp' : 'image/webp',
+    'tif' : 'image/tiff',
+    'tiff' : 'image/tiff',
+}
+
+def buildParser():
+    parser = argparse.ArgumentParser(
+        prog = sys.argv[0],
+        description = 'Serve XYZ tiles of layers rendered on demand by the drivers of topo2exr')
+    parser.add_argument('--layer', dest='layer', type=str,
+        metavar=("DRIVER KEY|FILENAME DTYPE LAYER BANDS EXTENSION", "OPTION[=VALUE]"),
+        nargs='+', action="append", required=True,
+        help=f"Layer served at /LAYER/Z/X/Y, with the syntax of topo2exr. The extension gives the format of the tiles.")
+    parser.add_argument('--host', type=str, default='127.0.0.1', help="Address to listen on")
+    parser.add_argument('--port', type=int, default=8000, help="Port to listen on")
+    parser.add_argument('--tile-size', dest='tile_size', type=int, default=256, help="Size of the tiles in pixels")
+    parser.add_argument('--cache-size', dest='cache_size', type=misc.str2ByteSize, default='256m',
+        help="Memory given to the cache of rendered tiles (k, m, g)")
+    parser.add_argument('--jobs', type=int, default=0,
+        help="Renderer processes, 0 uses every cpu")
+    parser.add_argument('--performance-profile', dest='performance_profile',
+        type=str2PerformanceProfile, metavar='|'.join(PERFORMANCE_PROFILES),
+        default=os.environ.get('PERFORMANCE_PROFILE', 'default'),
+        help="GDAL settings of the renderers, as in topo2exr. Defaults to the env variable PERFORMANCE_PROFILE")
+    return parser
+
+def mercatorTileBounds(z, x, y):
+    tile_extent = WEB_MERCATOR_EXTENT / 2**z
+    left = -WEB_MERCATOR_EXTENT / 2 + x * tile_extent
+    top = WEB_MERCATOR_EXTENT / 2 - y * tile_extent
+    return (left, top - tile_extent, left + tile_extent, top)
+
+def encodeTile(ds, extension):
+    with MemoryFile() as memfile:
+        with memfile.open(
+                driver=raster_driver_extensions()[extension],
+                width=ds.width,
+                height=ds.height,
+                count=ds.count,
+                dtype=ds.dtypes[0],
+                crs=ds.crs,
+                transform=ds.transform) as tile_ds:
+            tile_ds.write(ds.read())
+        return memfile.read()
+
+# state of a renderer process, its drivers are kept warm between requests
+renderer = misc.dotdict(layers=None, drivers={}, tile_size=None, performance=None)
+
+def initRenderer(layers, tile_size, performance):
+    # a forked renderer must not share the sqlite connections of its parent
+    utils.grid.grids.clear()
+    utils.lru.bdd.clear()
+    renderer.layers = layers
+    renderer.tile_size = tile_size
+    renderer.performance = performance
+    applyCacheSize(performance)
+    renderer.drivers = topo2exr.buildDrivers(layers.values())
+
+def renderTile(name, z, x, y):
+    layer = renderer.layers[name]
+    bounds = mercatorTileBounds(z, x, y)
+    shape_bounds = box(*bounds)
+    gps_bounds = utils.geo.projectBounds(bounds, utils.geo.WGS84, src_crs=WEB_MERCATOR)
+
+    with performanceEnv(renderer.performance), sharedDatasets():
+        dst_ds = temporarydataset(
+            renderer.tile_size,
+            renderer.tile_size,
+            WEB_MERCATOR,
+            bounds=bounds,
+            count=layer.count,
+            dtype=layer.dtype)
+        try:
+            renderer.drivers[layer.driver](
+                dst_ds,
+                layer.bands,
+                shape_bounds,
+                gps_bounds,
+                layer.key,
+                layer.layer,
+                layer.options)
+            utils.postprocess.apply(dst_ds, layer.postprocess)
+            return encodeTile(dst_ds, layer.extension)
+        finally:
+            dst_ds.close()
+
+class TileCache(object):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.tiles = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            tile = self.tiles.get(key)
+            if tile is not None:
+                self.tiles.move_to_end(key)
+            return tile
+
+    def put(self, key, tile):
+        if len(tile) > self.max_size:
+            return
+        with self.lock:
+            if key in self.tiles:
+                return
+            self.tiles[key] = tile
+            self.size += len(tile)
+            while self.size > self.max_size:
+                _, evicted = self.tiles.popitem(last=False)
+                self.size -= len(evicted)
+
+class TileServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, layers, pool, cache):
+        super().__init__(address, TileRequestHandler)
+        self.layers = layers
+        self.pool = pool
+        self.cache = cache
+        # requests of a tile being rendered wait for it instead of rendering it again
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+
+    def tile(self, key):
+        tile = self.cache.get(key)
+        if tile is not None:
+            return tile
+        with self.pending_lock:
+            result = self.pending.get(key)
+            if result is None:
+                result = self.pool.apply_async(renderTile, key)
+                self.pending[key] = result
+        try:
+            tile = result.get()
+            self.cache.put(key, tile)
+            return tile
+        finally:
+            with self.pending_lock:
+                self.pending.pop(key, None)
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+    def parse(self):
+        parts = urllib.parse.urlparse(self.path).path.strip('/').split('/')
+        if len(parts) != 4:
+            raise ValueError(f"expected /LAYER/Z/X/Y")
+        name, z, x, y = parts
+        z, x, y = int(z), int(x), int(y.split('.')[0])
+        if z < 0 or not (0 <= x < 2**z and 0 <= y < 2**z):
+            raise ValueError(f"tile {z}/{x}/{y} is out of the grid")
+        return name, z, x, y
+
+    def reply(self, code, content, content_type='text/plain'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        try:
+            key = self.parse()
+        except ValueError as e:
+            self.reply(400, str(e).encode())
+            return
+        layer = self.server.layers.get(key[0])
+        if layer is None:
+            self.reply(404, f"unknown layer {key[0]}".encode())
+            return
+        try:
+            tile = self.server.tile(key)
+        except Exception as e:
+            traceback.print_exception(e)
+            self.reply(500, str(e).encode())
+            return
+        self.reply(200, tile, CONTENT_TYPES.get(layer.extension, 'application/octet-stream'))
+
+def validateLayers(parameters):
+    layers = {}
+    for parameter in parameters:
+        layer = topo2exr.validateLayer(parameter)
+        if layer.extension == utils.exr.EXR_EXTENSION:
+            raise Exception(f"Layer {layer.layer} cannot be served as exr")
+        if layer.extension not in raster_driver_extensions():
+            raise Exception(f"Unknown extension {layer.extension} for layer {layer.layer}")
+        if layer.layer in layers:
+            raise Exception(f"Layer {layer.layer} is given twice")
+        utils.postprocess.checkTiledScale(layer.postprocess, layer.layer)
+        layers[layer.layer] = layer
+    return layers
+
+def main(argv):
+    parser = buildParser()
+    args = parser.parse_args(argv[1:])
+    try:
+        layers = validateLayers(args.layer)
+    except Exception as e:
+        traceback.print_exception(e)
+        parser.print_usage()
+        sys.exit(1)
+
+    jobs = args.jobs if args.jobs > 0 else multiprocessing.cpu_count()
+    cache = TileCache(args.cache_size)
+    performance = performanceProfile(args.performance_profile, jobs)
+    with multiprocessing.Pool(
+            jobs,
+            initializer=initRenderer,
+            initargs=(layers, args.tile_size, performance)) as pool:
+        server = TileServer((args.host, args.port), layers, pool, cache)
+        print(f"Serving {', '.join(layers)} on http://{args.host}:{args.port}/LAYER/Z/X/Y with {jobs} renderers")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+if __name__ == "__main__":
+    main(sys.argv)
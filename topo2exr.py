@@ -7,7 +7,11 @@ import os.path
 import math
 import traceback
 import importlib
-import sentinel2.cloudless
+import json
+import tempfile
+import contextlib
+import multiprocessing
+import string
 from datetime import datetime
 from affine import Affine
 
@@ -16,23 +20,29 @@ from shapely.affinity import affine_transform
 from shapely import box
 import rasterio as rio
 from utils.rasterio import LOSSLESS_JPEG2000, allowedextension, makeintoshapelymatrix
-from utils.grid import tileFixedTiles, equigrid
+from utils.grid import tileFixedTiles, tileSizeFromMemoryBudget, equigrid
 import utils.geo
+import utils.manifest
+import utils.lru
+import utils.exr
+import utils.postprocess
+import utils.profiling as profiling
 import utils.misc as misc
-from drivers.raster import Raster2Raster
-from drivers.shape import Shape2Raster
-from drivers.gmt import Gmt2Raster
 
 from timeit import default_timer as timer
 
 #import usgs2raster
+# driver modules are only imported when a layer uses them
 driver_factory = misc.dotdict(
-    gmt = lambda : Gmt2Raster(),
-    raster = lambda : Raster2Raster(),
-    shape = lambda : Shape2Raster(),
+    gmt = lambda : importlib.import_module('drivers.gmt').Gmt2Raster(),
+    raster = lambda : importlib.import_module('drivers.raster').Raster2Raster(),
+    shape = lambda : importlib.import_module('drivers.shape').Shape2Raster(),
     sentinel2 = None,
 )
 
+PLAN_FILE_NAME = "plan.json"
+REPORT_FILE_NAME = "report.json"
+
 allowed_extension_writing = ' ,'.join(map(lambda x:f'.{x}', utils.rasterio.allowedextension('w')))
 
 def buildParser():
@@ -50,206 +60,687 @@ def buildParser():
     parser.add_argument('--widen-area', dest='dilate', type=float,
         metavar="DILATE_COEFFICIENT", nargs=1, default=0,
         help="Dilate area of interest, in %")    
+    parser.add_argument('--cull', action='store_true',
+        help="Only render the tiles intersecting the shape found by --deduce-area, not its whole bounding box")
     parser.add_argument('--size', required=True, type=misc.str2ByteSize, metavar="SIZE", nargs=1,
         help="Size of the resulting image in pixels (k and )")
     parser.add_argument('--tiling', dest='tiling', type=int,
         metavar=("TILE_WIDTH", "TILE_HEIGHT", "MIN_OVERLAP"), nargs=3,
         help="Produce tiles of size TILE_WIDTHxTILE_HEIGHT overlapping by at least MIN_OVERLAP pixels",
         default=(-1,-1,0))
+    parser.add_argument('--max-memory', dest='max_memory', type=misc.str2ByteSize, metavar="SIZE", nargs=1,
+        help="Memory budget of the render (k, m, g and t multipliers). Without --tiling, the tile size is "
+             "deduced from it; it also caps the number of tiles rendered at once by --jobs")
     parser.add_argument('--filename-format', type=str, dest='format_name', metavar='PYTHON_FORMAT_STRING', nargs=1,
         help="Describe what filename to use for output files. It will be parsed by str.format, "
              "with variables id, tile_x, tile_y, tile_x_count, tile_y_count,"
-             "layer, width, height, total_width, total_height, now, extension. Supported extensions are "
+             "layer, width, height, total_width, total_height, now, extension. With several tiles, a format "
+             "without id or both tile_x and tile_y gets _{id} before its extension. Supported extensions are "
              + allowed_extension_writing,
-             default="{layer}.{extension}")
+             default=["{layer}.{extension}"])
     parser.add_argument('--layer', dest='layer', type=str,
         metavar=("DRIVER KEY|FILENAME DTYPE LAYER BANDS EXTENSION", "OPTION[=VALUE]"),
         nargs='+', action="append",
         help=f"Raster to add to exr. Valid drivers are : {misc.getValid(driver_factory)}.")
+    parser.add_argument('--exr-name', dest='exr_name', type=str, default="topo",
+        help="Layer name given to --filename-format for the exr file gathering every layer with the exr extension")
+    parser.add_argument('--exr-compression', dest='exr_compression',
+        choices=utils.exr.EXR_COMPRESSIONS, default='zip',
+        help="Compression of the exr files")
+    parser.add_argument('--exr-rows', dest='exr_rows', type=int, default=256,
+        help="Number of scanlines written at once in exr files")
+    parser.add_argument('--cog', action='store_true',
+        help="Write layers with extension " + ', '.join(utils.rasterio.COG_EXTENSIONS)
+             + " as Cloud Optimized GeoTIFF, with internal blocks and overviews")
+    parser.add_argument('--cog-compression', dest='cog_compression',
+        choices=utils.rasterio.COG_COMPRESSIONS, default='DEFLATE',
+        help="Compression of the COG blocks")
+    parser.add_argument('--cog-predictor', dest='cog_predictor',
+        choices=utils.rasterio.COG_PREDICTORS, default='YES',
+        help="Predictor of the COG blocks, YES picks the one matching the dtype")
+    parser.add_argument('--cog-blocksize', dest='cog_blocksize', type=int, default=512,
+        help="Size of the internal COG blocks")
+    parser.add_argument('--cog-overview-resampling', dest='cog_overview_resampling',
+        choices=utils.rasterio.COG_OVERVIEW_RESAMPLINGS, default='average',
+        help="Resampling used to build the COG overviews")
+    parser.add_argument('--vrt', action='store_true',
+        help="Do not warp, write for each tile and layer a VRT warping the cached sources on the fly. "
+             "It can be materialized later, with gdal_translate for instance")
+    parser.add_argument('--profile', dest='profile_dir', type=str, metavar="DIR",
+        help=f"Dump cProfile statistics of every tile in DIR. Timings per stage are always written to {REPORT_FILE_NAME}")
+    parser.add_argument('--jobs', dest='jobs', type=int, metavar="N", default=1,
+        help="Number of processes rendering tiles in parallel. 0 means one per cpu")
+    parser.add_argument('--order', dest='order', choices=('tile', 'layer'), default='tile',
+        help="tile renders all the layers of a tile together, opening the shared sources once. "
+             "layer renders every tile of a layer before moving to the next layer")
+    parser.add_argument('--resume', action='store_true',
+        help="Skip the tiles that the manifest of --output records as completed with the same parameters")
+    parser.add_argument('--plan', action='store_true',
+        help=f"Do not render, report the sources to download and the memory needed per tile in {PLAN_FILE_NAME}")
+    # the env variables are converted as the options, argparse reports their invalid values
+    parser.add_argument('--performance-profile', dest='performance_profile',
+        type=utils.rasterio.str2PerformanceProfile, metavar='|'.join(utils.rasterio.PERFORMANCE_PROFILES),
+        default=os.environ.get('PERFORMANCE_PROFILE', 'default'),
+        help="GDAL settings of the run, the options below override them. fast-preview trades exactness for "
+             "speed, exact warps without approximation. Defaults to the env variable PERFORMANCE_PROFILE")
+    parser.add_argument('--gdal-cache', dest='gdal_cache', metavar="SIZE",
+        type=utils.rasterio.PERFORMANCE_CONVERTERS['cache_size'],
+        default=os.environ.get('PERFORMANCE_GDAL_CACHE'),
+        help="Size of the block cache of GDAL per process (k, m, g). Defaults to the env variable PERFORMANCE_GDAL_CACHE")
+    parser.add_argument('--warp-threads', dest='warp_threads', metavar="N|auto|ALL_CPUS",
+        type=utils.rasterio.PERFORMANCE_CONVERTERS['warp_threads'],
+        default=os.environ.get('PERFORMANCE_WARP_THREADS'),
+        help="Threads of each warp, auto shares the cpus between the --jobs. "
+             "Defaults to the env variable PERFORMANCE_WARP_THREADS")
+    parser.add_argument('--warp-error-threshold', dest='warp_error_threshold', metavar="PIXELS",
+        type=utils.rasterio.PERFORMANCE_CONVERTERS['error_threshold'],
+        default=os.environ.get('PERFORMANCE_WARP_ERROR_THRESHOLD'),
+        help="Error allowed to the approximate transformer of the warps, in pixels, 0 for an exact transform. "
+             "Defaults to the env variable PERFORMANCE_WARP_ERROR_THRESHOLD")
+    parser.add_argument('--jp2-threads', dest='jp2_threads', metavar="N|auto|ALL_CPUS",
+        type=utils.rasterio.PERFORMANCE_CONVERTERS['jp2_threads'],
+        default=os.environ.get('PERFORMANCE_JP2_THREADS'),
+        help="Threads of the jpeg2000 decoding and encoding. Defaults to the env variable PERFORMANCE_JP2_THREADS")
     return parser
 
+def validateLayer(parameters):
+    if len(parameters) < 6:
+        raise Exception(f"At least 6 arguments are necessary for a layer")
+    driver, key, dtype, layer, bands, extension, *options = parameters
+
+    if driver not in driver_factory:
+        raise Exception(f"Unknown driver {driver}")
+    if driver_factory[driver] is None:
+        raise Exception(f"Unsupported driver {driver}")
+
+    if extension == utils.exr.EXR_EXTENSION:
+        utils.exr.checkDtype(dtype)
+
+    bands = misc.decodeBands(bands)
+    options = misc.dictFromOptions(options)
+    return misc.dotdict(
+        driver=driver,
+        key=key,
+        dtype=np.dtype(dtype),
+        layer=layer,
+        count=max(bands),
+        bands=bands,
+        extension=extension,
+        postprocess=utils.postprocess.splitOptions(options),
+        options=options)
+
+def groupOutputs(layers, exr_name, virtual=False):
+    # every exr layer of a tile goes to one file, at the place of the first one
+    outputs = []
+    exr_output = None
+    for layer_idx, layer in enumerate(layers):
+        if virtual:
+            outputs.append(misc.dotdict(name=layer.layer, extension=utils.rasterio.VRT_EXTENSION, layers=[layer_idx]))
+        elif layer.extension != utils.exr.EXR_EXTENSION:
+            outputs.append(misc.dotdict(name=layer.layer, extension=layer.extension, layers=[layer_idx]))
+        elif exr_output is None:
+            exr_output = misc.dotdict(name=exr_name, extension=layer.extension, layers=[layer_idx])
+            outputs.append(exr_output)
+        else:
+            exr_output.layers.append(layer_idx)
+    return outputs
+
+def buildDrivers(layers, drivers=None):
+    # drivers already built are kept warm, only the missing ones are created
+    drivers = {} if drivers is None else drivers
+    for name in set(layer.driver for layer in layers):
+        if name not in drivers:
+            drivers[name] = driver_factory[name]()
+    return drivers
+
+def tiledFormatName(format_name):
+    # every tile needs its own filename, or the tiles overwrite each other
+    fields = {field for _, field, _, _ in string.Formatter().parse(format_name) if field}
+    if 'id' in fields or {'tile_x', 'tile_y'} <= fields:
+        return format_name
+    stem, dot, extension = format_name.rpartition('.{extension}')
+    if dot:
+        return f"{stem}_{{id}}{dot}{extension}"
+    return f"{format_name}_{{id}}"
+
+def prepareRun(args):
+    print(f"Validating layers")
+    layers = list(map(validateLayer, args.layer))
+    if args.vrt:
+        # rejected before anything is downloaded
+        for layer in layers:
+            utils.rasterio.gdalTypeName(layer.dtype)
+
+    print(f"Computing bounds for final image")
+    projection_crs = utils.geo.getCrsFromInput(args.projection)
+    shape_bounds,gps_bounds = utils.geo.deduceBoundsFromArgs(args, projection_crs)
+    bounds = shape_bounds.bounds
+    print(f"-- found : {bounds} with projection {projection_crs}")
+
+    cull_shape = None
+    if args.cull:
+        if not args.deduce_bounds:
+            raise Exception(f"--cull needs --deduce-area")
+        print(f"Reading shape used to cull tiles")
+        cull_shape = utils.geo.deduceShapeFromShapeFile(*args.deduce_bounds, projection_crs)
+
+    print(f"Computing final image dimensions")
+    width, height = misc.computeWidthHeight(args.size[0], bounds)
+    print(f"-- found : {width}x{height}")
+
+    main_transform = rio.transform.from_bounds(
+        *bounds,
+        width,
+        height)
+
+    print("Preparing tiling")
+    *tile_size, tile_overlap = args.tiling
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+
+    if tile_size == [-1,-1]:
+        tile_size = (width, height)
+        if args.max_memory is not None:
+            # every job renders its own tile at the same time
+            budget = args.max_memory[0] // jobs
+            tile_size = tileSizeFromMemoryBudget(
+                width,
+                height,
+                budget,
+                lambda tile_width, tile_height: estimateTileMemory(layers, tile_width, tile_height))
+            print(f"-- {tile_size[0]}x{tile_size[1]} tiles fit in {misc.byteSize2Str(budget)} per job")
+
+    tiling = tileFixedTiles((0,0,width,height), tile_size, tile_overlap)
+    _,_,(tile_x_count, tile_y_count),(tile_width, tile_height) = tiling
+    # numpy integers from the tiling would leak into the tile ids and the json outputs
+    tile_x_count, tile_y_count = int(tile_x_count), int(tile_y_count)
+    tile_width, tile_height = int(tile_width), int(tile_height)
+
+    option_rasterio = misc.dotdict(
+        mode='w+',
+        driver=None,
+        sharing=False,
+        width=tile_width,
+        height=tile_height,
+        crs=projection_crs,
+    )
+
+    print(f"{tile_x_count}x{tile_y_count} tiles will be used")
+    format_name = args.format_name[0]
+    if tile_x_count * tile_y_count > 1:
+        format_name = tiledFormatName(format_name)
+        if format_name != args.format_name[0]:
+            print(f"-- filenames do not tell the tiles apart, using {format_name}")
+    if tile_x_count * tile_y_count > 1:
+        for layer in layers:
+            utils.postprocess.checkTiledScale(layer.postprocess, layer.layer)
+
+    if args.max_memory is not None:
+        tile_memory = estimateTileMemory(layers, tile_width, tile_height)
+        in_flight = max(1, args.max_memory[0] // tile_memory)
+        if in_flight < jobs:
+            print(f"-- {misc.byteSize2Str(tile_memory)} per tile, only {in_flight} job(s) fit in "
+                  f"{misc.byteSize2Str(args.max_memory[0])}")
+            jobs = in_flight
+
+    cog_profile = None
+    if args.cog:
+        cog_profile = utils.rasterio.cogProfile(
+            compress=args.cog_compression,
+            predictor=args.cog_predictor,
+            blocksize=args.cog_blocksize,
+            overview_resampling=args.cog_overview_resampling)
+
+    performance = utils.rasterio.performanceProfile(
+        args.performance_profile,
+        jobs,
+        cache_size=args.gdal_cache,
+        warp_threads=args.warp_threads,
+        error_threshold=args.warp_error_threshold,
+        jp2_threads=args.jp2_threads)
+    print(f"GDAL performance profile {performance.name} : "
+          + ', '.join(f"{key}={performance[key]}" for key in utils.rasterio.PERFORMANCE_SETTINGS))
+
+    return misc.dotdict(
+        layers=layers,
+        outputs=groupOutputs(layers, args.exr_name, args.vrt),
+        performance=performance,
+        virtual=args.vrt,
+        cog_profile=cog_profile,
+        profile_dir=args.profile_dir,
+        jobs=jobs,
+        exr_compression=args.exr_compression,
+        exr_rows=args.exr_rows,
+        output=args.output,
+        format_name=format_name,
+        shape_bounds=shape_bounds,
+        gps_bounds=gps_bounds,
+        cull_shape=cull_shape,
+        width=width,
+        height=height,
+        main_transform=main_transform,
+        tiling=tiling,
+        tile_x_count=tile_x_count,
+        tile_y_count=tile_y_count,
+        tile_width=tile_width,
+        tile_height=tile_height,
+        option_rasterio=option_rasterio,
+        starting_date=datetime.now().replace(microsecond=0).isoformat(),
+    )
+
+def listTiles(run):
+    cull_shape_pixel_space = None
+    if run.cull_shape is not None:
+        cull_shape_pixel_space = affine_transform(run.cull_shape, makeintoshapelymatrix(~run.main_transform))
+    # ids are numbered on the whole grid, so that culling does not renumber the tiles
+    tiles = [
+        (idx * run.tile_y_count + idy, ((idx, idy), left_bottom, right_top))
+        for (idx, idy), left_bottom, right_top in equigrid(*run.tiling,
+                shape_bounds=cull_shape_pixel_space)]
+    if run.cull_shape is not None:
+        print(f"{len(tiles)} tiles out of {run.tile_x_count * run.tile_y_count} intersect the shape")
+    return tiles
+
+def listWorkItems(run, order='tile'):
+    tiles = listTiles(run)
+    all_outputs = list(range(len(run.outputs)))
+    if order == 'tile':
+        return [(tile, all_outputs) for tile in tiles]
+    return [
+        (tile, [output_idx])
+        for output_idx in all_outputs
+            for tile in tiles
+    ]
+
+def tileGeometry(run, tile):
+    tile_id,((idx, idy), (l, b), (r, u)) = tile
+
+    # trans = Affine.translation(-l, -b)   
+    # scale = Affine.scale(width / (r - l), height / (u - b))
+    # sub_transform = main_transform * trans
+
+    window_px = rio.windows.Window(l,b,run.width,run.height)
+    sub_transform = rio.windows.transform(window_px, run.main_transform)
+    window_box_px = box(l,b,r,u)
+    window_box = affine_transform(window_box_px, makeintoshapelymatrix(~sub_transform))
+    return misc.dotdict(
+        tile_id=tile_id + 1,
+        idx=idx + 1,
+        idy=idy + 1,
+        bounds_px=(l, b, r, u),
+        sub_transform=sub_transform,
+        window_box=window_box,
+    )
+
+def outputTileFilename(run, output, geometry):
+    return run.format_name.format(
+            id = geometry.tile_id,
+            tile_x = geometry.idx, tile_y = geometry.idy,
+            tile_x_count = run.tile_x_count, tile_y_count = run.tile_y_count,
+            layer = output.name,
+            width = run.tile_width, height = run.tile_height,
+            total_width = run.width, total_height = run.height,
+            now = run.starting_date,
+            extension = output.extension,
+        )
+
+def outputTileHash(run, output, geometry):
+    exr = output.extension == utils.exr.EXR_EXTENSION
+    return utils.manifest.hashParameters(
+        layers=[run.layers[layer_idx] for layer_idx in output.layers],
+        exr_compression=run.exr_compression if exr else None,
+        creation_options=None if exr else creationOptions(run, output.extension),
+        bounds_px=geometry.bounds_px,
+        transform=tuple(geometry.sub_transform),
+        option_rasterio=run.option_rasterio,
+        shape_bounds=run.shape_bounds.wkt,
+        # the other settings of the profile do not change the result
+        error_threshold=run.performance.error_threshold,
+    )
+
+def creationOptions(run, extension):
+    if run.cog_profile is not None and extension in utils.rasterio.COG_EXTENSIONS:
+        return run.cog_profile
+    return LOSSLESS_JPEG2000
+
+def renderLayerTile(run, drivers, layer, path, geometry, dtype=None, creation_options=None):
+    print(f"At filename {path}")
+    if creation_options is None:
+        creation_options = creationOptions(run, layer.extension)
+
+    print(f"-- Warping {layer.key}")
+    option_image = (
+        run.option_rasterio
+        | misc.dotdict(
+            transform=geometry.sub_transform,
+            count=layer.count,
+            dtype=layer.dtype if dtype is None else dtype)
+        | creation_options)
+
+    with profiling.stage('create'):
+        dst_ds = rio.open(path, **option_image)
+    try:
+        drivers[layer.driver](
+            dst_ds,
+            layer.bands,
+            run.shape_bounds,
+            run.gps_bounds,# & window_box_gps,
+            layer.key,
+            layer.layer,
+            layer.options)
+
+        with profiling.stage('postprocess'):
+            utils.postprocess.apply(dst_ds, layer.postprocess)
+    finally:
+        # buffered formats such as jpeg2000 are encoded when closing
+        with profiling.stage('write'):
+            dst_ds.close()
+    return path
+
+# layers of an exr are rendered aside, striped so that scanlines are read back cheaply
+EXR_INTERMEDIATE = dict(driver='GTiff')
+
+def renderExrTile(run, drivers, output, path, geometry):
+    with tempfile.TemporaryDirectory(dir=run.output) as tmp_dir, contextlib.ExitStack() as stack:
+        channels = []
+        for layer_idx in output.layers:
+            layer = run.layers[layer_idx]
+            layer_path = renderLayerTile(
+                run,
+                drivers,
+                layer,
+                os.path.join(tmp_dir, f"{layer_idx}.tif"),
+                geometry,
+                dtype=utils.exr.renderDtype(layer.dtype),
+                creation_options=EXR_INTERMEDIATE)
+            layer_ds = stack.enter_context(rio.open(layer_path))
+            channels += [
+                (name, layer_ds, band, layer.dtype)
+                for band, name in enumerate(utils.exr.channelNames(layer.layer, layer.count), 1)]
+        print(f"-- Writing {len(channels)} channels to {path}")
+        with profiling.stage('exr'):
+            return utils.exr.exportDatasets(
+                path,
+                channels,
+                run.tile_width,
+                run.tile_height,
+                run.exr_compression,
+                run.exr_rows)
+
+def renderVirtualTile(run, drivers, layer, path, geometry):
+    print(f"At filename {path}")
+    bounds = rio.transform.array_bounds(run.tile_height, run.tile_width, geometry.sub_transform)
+    options = misc.capitalizeOptions(layer.options, drivers[layer.driver].option_type)
+    sources = drivers[layer.driver].sourcesForVirtual(
+        bounds, run.tile_width, run.gps_bounds, layer.key, options, crs=run.option_rasterio.crs)
+    print(f"-- Indexing {len(sources)} sources of {layer.key}")
+    with profiling.stage('vrt'):
+        return utils.rasterio.warpvrt(
+            sources,
+            path,
+            run.option_rasterio.crs,
+            bounds,
+            run.tile_width,
+            run.tile_height,
+            layer.dtype,
+            layer.bands,
+            options.get('resampling'))
+
+def renderOutputTile(run, drivers, output, geometry):
+    path = os.path.join(run.output, outputTileFilename(run, output, geometry))
+    if run.virtual:
+        return renderVirtualTile(run, drivers, run.layers[output.layers[0]], path, geometry)
+    if output.extension == utils.exr.EXR_EXTENSION:
+        return renderExrTile(run, drivers, output, path, geometry)
+    return renderLayerTile(run, drivers, run.layers[output.layers[0]], path, geometry)
+
+# State of the current process when rendering, either the main process or a worker of the pool
+worker = misc.dotdict(run=None, drivers={})
+
+def initWorker(run, forked=False):
+    if forked:
+        # a forked worker must not share the sqlite connections of its parent
+        utils.grid.grids.clear()
+        utils.lru.bdd.clear()
+        worker.drivers = {}
+    # workers shared by several runs receive theirs with the work items
+    if run is not None:
+        worker.run = run
+        utils.rasterio.applyCacheSize(run.performance)
+        worker.drivers = buildDrivers(run.layers, worker.drivers)
+
+def renderRunWorkItem(run_work_item):
+    run, work_item = run_work_item
+    initWorker(run)
+    return renderWorkItem(work_item)
+
+def renderWorkItem(work_item):
+    tile, output_indices = work_item
+    run = worker.run
+    geometry = tileGeometry(run, tile)
+    print(f"processing tile nb {geometry.tile_id}({geometry.idx},{geometry.idy}) "
+          f"out of {run.tile_x_count}x{run.tile_y_count}")
+    results = []
+    profile_path = None
+    if run.profile_dir is not None:
+        profile_path = os.path.join(run.profile_dir, f"tile_{geometry.tile_id}_{os.getpid()}.prof")
+    # every layer of the tile reuses the sources opened by the previous ones
+    with (profiling.profileTo(profile_path),
+          utils.rasterio.performanceEnv(run.performance),
+          utils.rasterio.sharedDatasets(),
+          utils.lru.pinning()):
+        for output_idx in output_indices:
+            output = run.outputs[output_idx]
+            print(f"processing layer : {output.name}")
+            start = timer()
+            cache_snapshot = utils.lru.statistics()
+            result = misc.dotdict(
+                tile_id=geometry.tile_id,
+                layer=output.name,
+                filename=outputTileFilename(run, output, geometry),
+                pid=os.getpid(),
+                path=None,
+                error=None)
+            with profiling.collect() as stage_timer:
+                try:
+                    result.path = renderOutputTile(run, worker.drivers, output, geometry)
+                except Exception as e:
+                    traceback.print_exception(e)
+                    result.error = f"{type(e).__name__}: {e}"
+            result.duration = timer() - start
+            result.stages = stage_timer.asDict()
+            result.cache = utils.lru.statisticsSince(cache_snapshot)
+            results.append(result)
+    return results
+
+def skipCompleted(run, work_items, manifest, resume):
+    pending_items = []
+    digests = {}
+    skipped = 0
+    for tile, output_indices in work_items:
+        geometry = tileGeometry(run, tile)
+        pending = []
+        for output_idx in output_indices:
+            output = run.outputs[output_idx]
+            filename = outputTileFilename(run, output, geometry)
+            digest = outputTileHash(run, output, geometry)
+            if resume and manifest.isComplete(filename, digest):
+                skipped += 1
+                continue
+            # stays started if the run dies while writing it
+            manifest.mark(filename, digest, utils.manifest.STARTED)
+            digests[filename] = digest
+            pending.append(output_idx)
+        if pending:
+            pending_items.append((tile, pending))
+    manifest.save()
+    if resume:
+        print(f"{skipped} tiles already completed are skipped")
+    return pending_items, digests
+
+def render(run, jobs=1, order='tile', resume=False, pool=None):
+    start = timer()
+    misc.createHierachy(run.output)
+    if run.profile_dir is not None:
+        misc.createHierachy(run.profile_dir)
+    manifest = utils.manifest.RunManifest(run.output)
+    work_items, digests = skipCompleted(run, listWorkItems(run, order), manifest, resume)
+    print(f"{len(work_items)} work items to render with {jobs} job(s), {order} major")
+
+    def reportResults(count, item_results):
+        for result in item_results:
+            manifest.mark(
+                result.filename,
+                digests[result.filename],
+                utils.manifest.DONE if result.error is None else utils.manifest.FAILED,
+                duration=result.duration)
+            if result.error is None:
+                print(f"-- [{count}/{len(work_items)}] tile {result.tile_id} of layer {result.layer} "
+                      f"finished in {result.duration:.2f}s. Please check {result.path}")
+            else:
+                print(f"-- [{count}/{len(work_items)}] tile {result.tile_id} of layer {result.layer} "
+                      f"failed after {result.duration:.2f}s : {result.error}")
+        manifest.save()
+        return item_results
+
+    if pool is not None:
+        # a pool kept by the caller, its workers keep their drivers, grids and caches between runs
+        results = [
+            result
+            for count, item_results in enumerate(
+                pool.imap_unordered(renderRunWorkItem, [(run, work_item) for work_item in work_items]), 1)
+                for result in reportResults(count, item_results)]
+    elif jobs <= 1:
+        initWorker(run)
+        results = [
+            result
+            for count, work_item in enumerate(work_items, 1)
+                for result in reportResults(count, renderWorkItem(work_item))]
+    else:
+        with multiprocessing.Pool(
+                processes=jobs,
+                initializer=initWorker,
+                initargs=(run, True)) as pool:
+            results = [
+                result
+                for count, item_results in enumerate(
+                    pool.imap_unordered(renderWorkItem, work_items), 1)
+                    for result in reportResults(count, item_results)]
+
+    failed = [result for result in results if result.error is not None]
+    total = sum(result.duration for result in results)
+    print(f"{len(results) - len(failed)} tiles rendered, {len(failed)} failed, "
+          f"{total:.2f}s spent in tiles")
+    for result in failed:
+        print(f"-- tile {result.tile_id} of layer {result.layer} failed : {result.error}")
+    cache_statistics = utils.lru.sumStatistics(result.cache for result in results)
+    for lru_name, counters in cache_statistics.items():
+        print(f"-- cache {lru_name} : {counters.get('hits', 0)} hits, {counters.get('misses', 0)} misses, "
+              f"{counters.get('evictions', 0)} evictions")
+
+    report_path = profiling.writeReport(
+        os.path.join(run.output, REPORT_FILE_NAME),
+        results,
+        jobs=jobs,
+        order=order,
+        duration=timer() - start,
+        failed=len(failed),
+        cache=cache_statistics)
+    print(f"Timings per stage written to {report_path}")
+    return results
+
+def estimateLayerMemory(layer, tile_width, tile_height):
+    # half floats of an exr are rendered in float
+    dtype = layer.dtype
+    if layer.extension == utils.exr.EXR_EXTENSION:
+        dtype = utils.exr.renderDtype(layer.dtype)
+    warp_memory = utils.rasterio.estimateWarpMemory(
+        tile_width,
+        tile_height,
+        layer.count,
+        dtype,
+        layer.options.get('blocksize'))
+    return warp_memory + utils.postprocess.estimateMemory(layer.postprocess, tile_width, tile_height, dtype)
+
+def estimateTileMemory(layers, tile_width, tile_height):
+    # layers of a tile are rendered one after the other
+    return max(estimateLayerMemory(layer, tile_width, tile_height) for layer in layers)
+
+def planRun(run, jobs=1):
+    drivers = buildDrivers(run.layers, worker.drivers)
+    tiles = listTiles(run)
+    sources = {}
+    tile_plans = []
+    for tile in tiles:
+        geometry = tileGeometry(run, tile)
+        bounds = rio.transform.array_bounds(run.tile_height, run.tile_width, geometry.sub_transform)
+        print(f"planning tile nb {geometry.tile_id}({geometry.idx},{geometry.idy}) "
+              f"out of {run.tile_x_count}x{run.tile_y_count}")
+        # only the sources covering this tile, not the whole area
+        tile_gps_bounds = run.gps_bounds.intersection(
+            utils.geo.projectBounds(bounds, utils.geo.WGS84, src_crs=run.option_rasterio.crs))
+        tile_sources = {}
+        layer_plans = []
+        for layer in run.layers:
+            planned = drivers[layer.driver].planToRaster(
+                bounds, run.tile_width, tile_gps_bounds, layer.key, layer.options, crs=run.option_rasterio.crs)
+            tile_sources |= {source.source:source for source in planned}
+            layer_plans.append(misc.dotdict(
+                layer=layer.layer,
+                sources=[source.source for source in planned],
+                memory=estimateLayerMemory(layer, run.tile_width, run.tile_height)))
+        sources |= tile_sources
+        missing = [source for source in tile_sources.values() if not source.cached]
+        tile_plan = misc.dotdict(
+            tile_id=geometry.tile_id,
+            tile_x=geometry.idx,
+            tile_y=geometry.idy,
+            layers=layer_plans,
+            cached=len(tile_sources) - len(missing),
+            to_download=len(missing),
+            download_size=sum(source.size or 0 for source in missing),
+            memory=max((layer_plan.memory for layer_plan in layer_plans), default=0))
+        print(f"-- {len(tile_sources)} sources, {tile_plan.cached} cached, "
+              f"{tile_plan.to_download} to download ({misc.byteSize2Str(tile_plan.download_size)}), "
+              f"peak memory {misc.byteSize2Str(tile_plan.memory)}")
+        tile_plans.append(tile_plan)
+
+    missing = [source for source in sources.values() if not source.cached]
+    download_size = sum(source.size or 0 for source in missing)
+    memory = max((tile_plan.memory for tile_plan in tile_plans), default=0)
+    print(f"Plan for {len(tile_plans)} tiles and {len(run.layers)} layers")
+    print(f"-- {len(sources)} distinct sources, {len(sources) - len(missing)} cached")
+    print(f"-- {len(missing)} to download, about {misc.byteSize2Str(download_size)}")
+    print(f"-- peak memory {misc.byteSize2Str(memory)} per tile, "
+          f"{misc.byteSize2Str(memory * jobs)} with {jobs} job(s)")
+
+    misc.createHierachy(run.output)
+    plan_path = os.path.join(run.output, PLAN_FILE_NAME)
+    with open(plan_path, 'w') as f:
+        json.dump(misc.dotdict(
+            tiles=tile_plans,
+            to_download=sorted(source.source for source in missing),
+            download_size=download_size,
+            memory_per_tile=memory,
+            jobs=jobs), f, indent=1, default=int)
+    print(f"-- written to {plan_path}")
+
 def main(argv):
     parser = buildParser()
     args = parser.parse_args(argv[1:])
 
     try:
-        print(f"Creating drivers")
-
-        def validate_layer(parameters):
-            if len(parameters) < 6:
-                raise Exception(f"At least 6 arguments are necessary for a layer")
-            driver, key, dtype, layer, bands, extension, *options = parameters
-
-            if driver not in driver_factory:
-                raise Exception(f"Unknown driver {driver}")
-            if driver_factory[driver] is None:
-                raise Exception(f"Unsupported driver {driver}")
-
-            bands = misc.decodeBands(bands)
-            return misc.dotdict(
-                driver=driver,
-                key=key,
-                dtype=np.dtype(dtype),
-                layer=layer,
-                count=max(bands),
-                bands=bands,
-                extension=extension,
-                options=misc.dictFromOptions(options))
-
-        layers = list(map(validate_layer, args.layer))
-
-        print(f"Building drivers")
-        drivers = {
-            name:driver_factory[name]()
-            for name in set(layer.driver for layer in layers)
-        }
-
-        print(f"Computing bounds for final image")
-        projection_crs = utils.geo.getCrsFromInput(args.projection)
-        shape_bounds,gps_bounds = utils.geo.deduceBoundsFromArgs(args, projection_crs)
-        bounds = shape_bounds.bounds
-        print(f"-- found : {bounds} with projection {projection_crs}")
-
-        print(f"Computing final image dimensions")
-        width, height = misc.computeWidthHeight(args.size[0], bounds)
-        print(f"-- found : {width}x{height}")
-
-        main_transform = rio.transform.from_bounds(
-            *bounds,
-            width,
-            height)
-
-        main_transform_gps = rio.transform.from_bounds(
-            *gps_bounds.bounds,
-            width,
-            height)
-
-        format_name = args.format_name[0]
-
-        print("Preparing tiling")
-        *tile_size, tile_overlap = args.tiling
-
-        if tile_size == [-1,-1]:
-            tile_size = (width, height)
-
-        tiling = tileFixedTiles((0,0,width,height), tile_size, tile_overlap)
-        _,_,(tile_x_count, tile_y_count),(tile_width, tile_height) = tiling
-
-        option_rasterio = misc.dotdict(
-            mode='w+',
-            driver=None,
-            sharing=False,
-            width=tile_width,
-            height=tile_height,
-            crs=projection_crs,
-        )
-
-        print(f"{tile_x_count}x{tile_y_count} tiles will be used")
+        run = prepareRun(args)
     except Exception as e:
         traceback.print_exception(e)
         parser.print_usage()
         sys.exit(1)
-    
-    output = args.output
-    misc.createHierachy(output)
-
-    shape_bounds_pixel_space = affine_transform(shape_bounds, makeintoshapelymatrix(~main_transform))
-
-    starting_date = datetime.now().replace(microsecond=0).isoformat()
 
-    for layer in layers:
-        print(f"processing layer : {layer.layer}")
-
-        for tile_id,tile in enumerate(equigrid(*tiling,
-                shape_bounds=None and shape_bounds_pixel_space)):
-            start = timer()
-            (idx, idy), (l, b), (r, u) = tile
-            tile_id += 1
-            idx += 1
-            idy += 1
-            print(f"processing tile nb {tile_id}({idx},{idy}) out of {tile_x_count}x{tile_y_count}")
-            filename = format_name.format(
-                    id = tile_id,
-                    tile_x = idx, tile_y = idy,
-                    tile_x_count = tile_x_count, tile_y_count = tile_y_count,
-                    layer = layer.layer,
-                    width = tile_width, height = tile_height,
-                    total_width = width, total_height = height,
-                    now = starting_date,
-                    extension = layer.extension,
-                )
-            path = os.path.join(output, filename)
-            print(f"At filename {path}")
-
-            # trans = Affine.translation(-l, -b)   
-            # scale = Affine.scale(width / (r - l), height / (u - b))
-            # sub_transform = main_transform * trans
-
-            window_px = rio.windows.Window(l,b,width,height)
-            sub_transform = rio.windows.transform(window_px, main_transform)
-            window_box_px = box(l,b,r,u)
-            window_box = affine_transform(window_box_px, makeintoshapelymatrix(~sub_transform))
-
-            shall_patch_holes = 'fillnodata' in layer.options
-            shall_scale_01 = 'scale01' in layer.options
-            shall_scale_11 = 'scale11' in layer.options
-            layer.options.pop('fillnodata', None)
-            layer.options.pop('scale01', None)
-            layer.options.pop('scale11', None)
-            # if shall_scale_01 or shall_scale_11:
-            #     if 'min_value' not in layer.dtype:
-            #         raise Exception('impossible to scale down with this type')
-            #     min_value, max_value = (layer.dtype['min_value'], layer.dtype['max_value'])
-
-            print(f"-- Warping {layer.key}")
-            option_image = (
-                option_rasterio
-                | misc.dotdict(
-                    transform=sub_transform,
-                    count=layer.count,
-                    dtype=layer.dtype)
-                | LOSSLESS_JPEG2000)
-    
-            with rio.open(path, **option_image) as dst_ds:
-                drivers[layer.driver](
-                    dst_ds,
-                    layer.bands,
-                    shape_bounds,
-                    gps_bounds,# & window_box_gps,
-                    layer.key,
-                    layer.layer,
-                    layer.options)
-
-                if False:
-                    data = {}
-                    if shall_patch_holes:
-                        print("-- patching holes in data")
-                    if shall_scale_01:
-                        print("-- scaling to [0,1]")
-                    elif shall_scale_11:
-                        print("-- scaling to [-1,1]")
-
-                    for i, name in enumerate(layer_name):
-                        np_array = dst_ds.read(i + 1)
-                        if 'force_view' in layer.dtype:
-                            np_array = np_array.view(layer.dtype['force_view'])
-                        if shall_patch_holes:
-                            no_data = db.GetNoDataValue()
-                            np_array = util.fill(np_array, no_data)
-                        np_array = np_array.astype(layer.dtype['np_dtype'])
-                        if shall_scale_01:
-                            np_array = (np_array - min_value)/(max_value - min_value)
-                        elif shall_scale_11:
-                            np_array = 2*(np_array - min_value)/(max_value - min_value)-1
-
-                        histogram, base = np.histogram(np_array)
-                        print(f"-- histogram from {base[0]} to {base[-1]} : "
-                            f"{', '.join(str(i) for i in histogram)}")
-                        data[name] = np_array.tobytes()
-                    exr = OpenEXR.OutputFile(path, header)
-                    exr.writePixels(data)
-                print(f"-- finished in {timer()-start:.2f}s. Please check {path}")
-            
+    if args.plan:
+        planRun(run, run.jobs)
+        return
+    results = render(run, run.jobs, args.order, args.resume)
+    if any(result.error is not None for result in results):
+        sys.exit(1)
 
 
 
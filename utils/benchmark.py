@@ -0,0 +1,130 @@
+import os
+import sys
+import argparse
+import tempfile
+import subprocess
+import statistics
+import numpy as np
+import rasterio as rio
+from rasterio.enums import Resampling
+import utils.handles
+from utils.rasterio import temporarydataset, warpmerge
+from timeit import default_timer as timer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOPO2EXR = os.path.join(ROOT, 'topo2exr.py')
+
+# modules which should only be imported by the drivers needing them
+HEAVY_MODULES = (
+    'sentinel2.cloudless',
+    's2cloudless',
+    'skimage',
+    'matplotlib',
+    'google.cloud',
+    'sentinelsat',
+    'spatialite',
+    'fiona',
+    'tqdm',
+    'osgeo',
+    'cv2',
+)
+
+def buildParser():
+    parser = argparse.ArgumentParser(
+        prog = f"{sys.argv[0]} submodule utils.benchmark",
+        description = 'Measure the startup time of topo2exr, or the time of downsampled warps')
+    parser.add_argument('mode', nargs='?', choices=('startup', 'downsampling'), default='startup',
+        help="startup times topo2exr commands, downsampling times warpmerge with and without overviews")
+    parser.add_argument('--repeat', type=int, default=5, help="Runs of each measure")
+    parser.add_argument('--size', type=int, default=256, help="Width of the small raster job, or of the downsampled render")
+    parser.add_argument('--source-size', dest='source_size', type=int, default=8192,
+        help="Width of the source raster downsampled")
+    return parser
+
+def timeCommand(command, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = timer()
+        subprocess.run(command, check=True, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        durations.append(timer() - start)
+    return durations
+
+def importedHeavyModules():
+    script = (
+        "import sys, topo2exr\n"
+        f"print('\\n'.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))")
+    output = subprocess.run([sys.executable, '-c', script], check=True, cwd=ROOT, capture_output=True, text=True)
+    return output.stdout.split()
+
+def writeSampleRaster(path, size, overviews=False):
+    bounds = (5, 45, 6, 46)
+    with rio.open(
+            path,
+            'w',
+            driver='GTiff',
+            width=size,
+            height=size,
+            count=1,
+            dtype=np.float32,
+            crs='EPSG:4326',
+            tiled=True,
+            transform=rio.transform.from_bounds(*bounds, size, size)) as ds:
+        ds.write(np.random.default_rng(0).random((1, size, size), dtype=np.float32))
+        if overviews:
+            factors = [2**i for i in range(1, int(np.log2(size // 256)) + 1)]
+            ds.build_overviews(factors, Resampling.average)
+    return bounds
+
+def benchmarkDownsampling(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source = os.path.join(tmp_dir, 'source.tif')
+        bounds = writeSampleRaster(source, args.source_size, overviews=True)
+        print(f"downsampling {args.source_size}x{args.source_size} into {args.size}x{args.size}")
+        medians = {}
+        for name, options in (('full resolution', dict(full_resolution=None)), ('overviews', dict())):
+            durations = []
+            for _ in range(args.repeat):
+                # no handle is reused from the previous run
+                utils.handles.handlePool().close()
+                with temporarydataset(args.size, args.size, 'EPSG:4326', bounds=bounds, dtype=np.float32) as dst_ds:
+                    start = timer()
+                    warpmerge([source], dst_ds, resampling='average', **options)
+                    durations.append(timer() - start)
+            medians[name] = statistics.median(durations)
+            print(f"{name:>16} : median {medians[name]:.3f}s min {min(durations):.3f}s max {max(durations):.3f}s")
+        print(f"-- overviews are {medians['full resolution'] / medians['overviews']:.1f}x faster")
+
+def benchmarkStartup(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sample = os.path.join(tmp_dir, 'sample.tif')
+        bounds = writeSampleRaster(sample, args.size)
+        commands = {
+            'import' : [sys.executable, '-c', 'import topo2exr'],
+            '--help' : [sys.executable, TOPO2EXR, '--help'],
+            'raster job' : [sys.executable, TOPO2EXR,
+                '--output', os.path.join(tmp_dir, 'output'),
+                '--area', *map(str, bounds),
+                '--size', str(args.size),
+                '--jobs', '1',
+                '--layer', 'raster', sample, 'float32', 'height', '1', 'tif'],
+        }
+        for name, command in commands.items():
+            durations = timeCommand(command, args.repeat)
+            print(f"{name:>12} : median {statistics.median(durations):.3f}s"
+                  f" min {min(durations):.3f}s max {max(durations):.3f}s")
+
+    heavy_modules = importedHeavyModules()
+    if heavy_modules:
+        print(f"-- importing topo2exr loads {', '.join(heavy_modules)}")
+    else:
+        print(f"-- importing topo2exr loads none of {', '.join(HEAVY_MODULES)}")
+
+def main(argv):
+    args = buildParser().parse_args(argv[1:])
+    if args.mode == 'downsampling':
+        benchmarkDownsampling(args)
+    else:
+        benchmarkStartup(args)
+
+if __name__ == "__main__":
+    main(sys.argv)
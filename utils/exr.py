@@ -0,0 +1,83 @@
+import numpy as np
+import rasterio as rio
+
+# OpenEXR and Imath are only needed when writing exr, they are imported on first use
+EXR_EXTENSION = "exr"
+EXR_COMPRESSIONS = ('none', 'rle', 'zips', 'zip', 'piz', 'pxr24', 'b44', 'b44a', 'dwaa', 'dwab')
+EXR_PIXEL_TYPES = {
+    'float16': 'HALF',
+    'float32': 'FLOAT',
+    'uint32': 'UINT',
+}
+RGBA_CHANNELS = ('R', 'G', 'B', 'A')
+
+def importOpenEXR():
+    try:
+        import OpenEXR
+        import Imath
+    except ImportError as e:
+        raise Exception("OpenEXR python bindings are needed to write exr files") from e
+    return OpenEXR, Imath
+
+def checkDtype(dtype):
+    if np.dtype(dtype).name not in EXR_PIXEL_TYPES:
+        raise Exception(f"invalid dtype {dtype} for exr. Valid dtypes are : {', '.join(EXR_PIXEL_TYPES)}")
+
+def renderDtype(dtype):
+    # GDAL has no half float, render in float and convert while writing
+    return np.float32 if np.dtype(dtype) == np.float16 else np.dtype(dtype)
+
+def channelNames(layer_name, count):
+    if count == 1:
+        return [layer_name]
+    if count <= len(RGBA_CHANNELS):
+        return [f"{layer_name}.{channel}" for channel in RGBA_CHANNELS[:count]]
+    return [f"{layer_name}.B{band}" for band in range(1, count + 1)]
+
+class ExrWriter(object):
+    def __init__(self, path, width, height, channels, compression='zip'):
+        OpenEXR, Imath = importOpenEXR()
+        if compression not in EXR_COMPRESSIONS:
+            raise Exception(f"invalid exr compression {compression}. "
+                            f"Valid compressions are : {', '.join(EXR_COMPRESSIONS)}")
+        compression = 'NO' if compression == 'none' else compression.upper()
+        self.dtypes = {name:np.dtype(dtype) for name, dtype in channels.items()}
+        header = OpenEXR.Header(width, height)
+        header['channels'] = {
+            name:Imath.Channel(Imath.PixelType(
+                getattr(Imath.PixelType, EXR_PIXEL_TYPES[dtype.name])))
+            for name, dtype in self.dtypes.items()}
+        header['compression'] = Imath.Compression(
+            getattr(Imath.Compression, f"{compression}_COMPRESSION"))
+        self.exr = OpenEXR.OutputFile(path, header)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def writeRows(self, rows, data):
+        self.exr.writePixels(
+            {name:np.ascontiguousarray(array, dtype=self.dtypes[name]).tobytes()
+             for name, array in data.items()},
+            rows)
+
+    def close(self):
+        self.exr.close()
+
+def exportDatasets(path, channels, width, height, compression='zip', rows_per_chunk=256):
+    # channels are (name, dataset, band, dtype), read and written by chunks of scanlines
+    with ExrWriter(
+            path,
+            width,
+            height,
+            {name:dtype for name, _, _, dtype in channels},
+            compression) as exr:
+        for row in range(0, height, rows_per_chunk):
+            window = rio.windows.Window(0, row, width, min(rows_per_chunk, height - row))
+            exr.writeRows(
+                window.height,
+                {name:dataset.read(band, window=window)
+                 for name, dataset, band, _ in channels})
+    return path
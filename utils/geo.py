@@ -1,9 +1,9 @@
 from rasterio.crs import CRS
 from rasterio import features, warp
 from shapely import geometry, ops, prepared, box
-import fiona
 import pprint
 import warnings
+import utils.handles
 
 WGS84 = CRS.from_epsg(4326)
 
@@ -26,7 +26,16 @@ def checkIfDsIntersect(test_ds, ref_ds):
     return box1.intersects(box2)
 
 def readFeaturesFromShapeFile(shape_file, bounds=None, where=None, crs=None, getattribute=None):
-    source = fiona.open(shape_file, "r")
+    # the shapefile stays open in the handle pool for the following tiles
+    pool = utils.handles.handlePool()
+    key = ('vector', shape_file)
+    source = pool.acquire(key)
+    try:
+        yield from filterFeatures(source, bounds, where, crs, getattribute)
+    finally:
+        pool.release(key)
+
+def filterFeatures(source, bounds, where, crs, getattribute):
     crs = source.crs if crs is None else crs
     src_crs = source.crs
     if bounds is not None:
@@ -42,14 +51,16 @@ def readFeaturesFromShapeFile(shape_file, bounds=None, where=None, crs=None, get
         return (shape if getattribute is None
                     else (shape, feature.properties.get(getattribute, None)))
 
-    return (
-        featureToElement(feature)
-        for feature in source.filter(where=where,bbox=bounds))
+    for feature in source.filter(where=where,bbox=bounds):
+        yield featureToElement(feature)
+
+def deduceShapeFromShapeFile(shape_file, where, crs):
+    return ops.unary_union(list(readFeaturesFromShapeFile(shape_file, where=where, crs=crs)))
 
 def deduceBoundsFromShapeFile(shape_file, where, crs):
     print(f"-- deducing bounds from shapefile {shape_file} where {where}")
     warnings.warn("be smarter")
-    obj = ops.unary_union(list(readFeaturesFromShapeFile(shape_file, where=where, crs=crs)))
+    obj = deduceShapeFromShapeFile(shape_file, where, crs)
     return box(*obj.bounds)
 
 def deduceBoundsFromArgs(args, projection):
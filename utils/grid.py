@@ -1,13 +1,18 @@
 from shapely import geometry, from_wkt, box
 import pprint
 import utils.misc as misc
-import spatialite
 import math
 import os
 import timeit
 import dotenv
 import numpy as np
-from shapely.prepared import prep
+import shapely
+
+def cullTiles(xs, ys, tile_size, shape):
+    x, y = np.meshgrid(xs, ys, indexing='ij')
+    tiles = shapely.box(x, y, x + tile_size[0], y + tile_size[1])
+    shapely.prepare(shape)
+    return shapely.intersects(shape, tiles)
 
 def equigrid(env_left_bottom,
              env_right_top,
@@ -15,15 +20,16 @@ def equigrid(env_left_bottom,
              tile_size,
              mapping=lambda *args:args,
              shape_bounds=None):
-    if shape_bounds is not None:
-        shape_bounds = prep(shape_bounds)
     start = env_left_bottom
     end = env_right_top - tile_size
-    return (mapping((idx, idy), (x, y), (x + tile_size[0], y + tile_size[1]))
-        for     idx,x in enumerate(np.linspace(start[0], end[0], tile_count[0]))
-            for idy,y in enumerate(np.linspace(start[1], end[1], tile_count[1]))
-                if shape_bounds is None
-                or shape_bounds.intersects(box(x,y,x+tile_size[0],y+tile_size[1]))
+    xs = np.linspace(start[0], end[0], tile_count[0])
+    ys = np.linspace(start[1], end[1], tile_count[1])
+    idx, idy = np.meshgrid(np.arange(len(xs)), np.arange(len(ys)), indexing='ij')
+    if shape_bounds is not None:
+        keep = cullTiles(xs, ys, tile_size, shape_bounds)
+        idx, idy = idx[keep], idy[keep]
+    return (mapping((int(i), int(j)), (xs[i], ys[j]), (xs[i] + tile_size[0], ys[j] + tile_size[1]))
+        for i,j in zip(idx.ravel(), idy.ravel())
     )
 
 def tileFixedTiles(bounds, tile_size, minimum_absolute_overlap=0):
@@ -41,6 +47,35 @@ def tileFixedTiles(bounds, tile_size, minimum_absolute_overlap=0):
     tile_count = misc.ceildivide(grid_min_breadth, tile_size - minimum_absolute_overlap)
     return env_left_bottom, env_right_top, tile_count, tile_size
 
+def largestFitting(low, high, fits):
+    # largest value in [low, high] for which fits holds, fits being monotonous
+    if not fits(low):
+        return None
+    while low < high:
+        middle = (low + high + 1) // 2
+        if fits(middle):
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+def tileSizeFromMemoryBudget(width, height, budget, memory):
+    if memory(width, height) <= budget:
+        return width, height
+    side = largestFitting(1, max(width, height),
+        lambda side: memory(min(side, width), min(side, height)) <= budget)
+    if side is None:
+        raise AttributeError(f"Impossible to tile, even a single pixel needs more than {budget} bytes")
+    tile_width, tile_height = min(side, width), min(side, height)
+    # a narrow image lets the tile grow along its long side
+    if tile_width == width:
+        tile_height = largestFitting(tile_height, height,
+            lambda tile_height: memory(width, tile_height) <= budget)
+    elif tile_height == height:
+        tile_width = largestFitting(tile_width, width,
+            lambda tile_width: memory(tile_width, height) <= budget)
+    return tile_width, tile_height
+
 def tileFixedCount(bounds, tile_count, overlap=0, is_overlap_relative=True, square=False):
     bounds = np.array(bounds).reshape(2,2)
     overlap = np.resize(overlap,2)
@@ -78,6 +113,7 @@ class EquiGridManager(object):
 class GridFromFile(object):
     def __init__(self, spatialite_file, table=None, crs=None):
         print(f"Loading {spatialite_file} into memory")
+        import spatialite
         self.db = spatialite.connect(spatialite_file)
         table_deducted = os.path.splitext(os.path.split(spatialite_file)[1])[0]
         self.table = table_deducted if table is None else table
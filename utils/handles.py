@@ -0,0 +1,127 @@
+import os
+import resource
+import warnings
+from collections import OrderedDict, Counter
+import rasterio as rio
+from rasterio import vrt
+import utils.misc as misc
+
+# descriptors left to the cache indexes, locks, outputs and gdal itself
+RESERVED_DESCRIPTORS = 64
+DEFAULT_POOL_DESCRIPTORS = 512
+# a warped vrt reads through its raster, a shapefile holds its .shp, .shx and .dbf
+DESCRIPTORS = dict(raster=1, warp=0, vector=3)
+
+def descriptorBudget():
+    budget = int(os.environ.get('DATASET_POOL_DESCRIPTORS', DEFAULT_POOL_DESCRIPTORS))
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY:
+        budget = min(budget, soft - RESERVED_DESCRIPTORS)
+    return max(budget, max(DESCRIPTORS.values()))
+
+def modificationTime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+# handles opened once per process and reused by the following tiles and layers, least recently used
+# ones are closed when the descriptors run out. Keys are ('raster', path, overview_level),
+# ('warp', path, overview_level, crs, resampling, error_threshold, threads) and ('vector', path),
+# None stands for the full resolution and the defaults of gdal
+class HandlePool(object):
+    def __init__(self, budget=None):
+        self.budget = descriptorBudget() if budget is None else budget
+        self.entries = OrderedDict()
+        self.used = 0
+        self.pid = os.getpid()
+        self.statistics = Counter()
+
+    def checkProcess(self):
+        # handles inherited through fork belong to the parent, they are left to it
+        if self.pid != os.getpid():
+            self.entries = OrderedDict()
+            self.used = 0
+            self.pid = os.getpid()
+
+    def openHandle(self, key):
+        kind, path, *parameters = key
+        if kind == 'raster':
+            overview_level, = parameters
+            if overview_level is None:
+                return rio.open(path)
+            return rio.open(path, overview_level=overview_level)
+        if kind == 'warp':
+            overview_level, crs, resampling, error_threshold, threads = parameters
+            options = {}
+            if error_threshold is not None:
+                options['tolerance'] = error_threshold
+            if threads is not None:
+                options['warp_extras'] = dict(NUM_THREADS=threads)
+            return vrt.WarpedVRT(
+                self.acquire(('raster', path, overview_level)),
+                crs=crs,
+                resampling=resampling,
+                **options)
+        if kind == 'vector':
+            import fiona
+            return fiona.open(path, "r")
+        raise Exception(f"Unknown handle kind {kind}")
+
+    def acquire(self, key):
+        self.checkProcess()
+        mtime = modificationTime(key[1])
+        entry = self.entries.get(key)
+        if entry is not None and entry.mtime != mtime and not entry.users:
+            # the file was replaced, by a new retrieval of the cache
+            self.discard(key)
+            entry = None
+        if entry is None:
+            self.statistics['misses'] += 1
+            weight = DESCRIPTORS[key[0]]
+            self.makeRoom(weight)
+            entry = misc.dotdict(handle=self.openHandle(key), weight=weight, mtime=mtime, users=0)
+            self.entries[key] = entry
+            self.used += weight
+        else:
+            self.statistics['hits'] += 1
+        self.entries.move_to_end(key)
+        entry.users += 1
+        return entry.handle
+
+    def release(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry.users -= 1
+
+    def discard(self, key):
+        entry = self.entries.pop(key)
+        entry.handle.close()
+        self.used -= entry.weight
+        self.statistics['evictions'] += 1
+        if key[0] == 'warp':
+            self.release(('raster', key[1], key[2]))
+
+    def makeRoom(self, weight):
+        while self.used + weight > self.budget:
+            # a warped vrt comes before its raster, it releases it when discarded
+            unused = misc.getFirstOrNone(key for key, entry in self.entries.items() if not entry.users)
+            if unused is None:
+                warnings.warn(f"every pooled dataset is in use, {self.used + weight} descriptors exceed {self.budget}")
+                return
+            self.discard(unused)
+
+    def close(self):
+        # warped vrts before the rasters they read
+        for key in sorted(self.entries, key=lambda key: key[0] != 'warp'):
+            self.entries[key].handle.close()
+        self.entries.clear()
+        self.used = 0
+
+handle_pool = None
+
+def handlePool():
+    global handle_pool
+    if handle_pool is None:
+        handle_pool = HandlePool()
+    return handle_pool
@@ -1,27 +1,195 @@
 import dotenv
 from pathlib import Path
 import os
-from collections import OrderedDict
+import sqlite3
+import fcntl
+import hashlib
+import fnmatch
+from timeit import default_timer as timer
 import utils.misc as misc
+import utils.profiling as profiling
 import time
+import contextlib
+import warnings
+from collections import Counter
 
+INDEX_FILE_NAME = '.lru-index.sqlite'
+LOCK_DIR_NAME = '.lru-locks'
+PARTIAL_PREFIX = '.partial.'
+
+def isProcessAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+@contextlib.contextmanager
+def fileLock(path, blocking=True, remove=False):
+    # yields whether the lock is held, it is released when the file is closed. A removed lock file is
+    # unlinked while still locked, the processes waiting on it lock it again under its new inode
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            os.close(fd)
+            yield False
+            return
+        try:
+            current = os.stat(path).st_ino == os.fstat(fd).st_ino
+        except FileNotFoundError:
+            current = False
+        if current:
+            break
+        os.close(fd)
+    try:
+        yield True
+    finally:
+        if remove:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+        os.close(fd)
+
+MEGABYTE = 1000_000
+# rows read at once by an eviction pass
+EVICTION_BATCH = 64
+# cost of the files whose retrieval was not timed, in seconds
+DEFAULT_COST = 1.
+
+def lruPriority(inflation, atime, size, cost):
+    return atime
+
+def costPriority(inflation, atime, size, cost):
+    # greedy dual size : expensive and small files stay longer, the inflation ages the others
+    return inflation + cost * MEGABYTE / max(size, 1)
+
+# files with the lowest priority are evicted first
+EVICTION_POLICIES = dict(
+    lru=lruPriority,
+    cost=costPriority,
+)
+
+def parseTtlRules(rules):
+    # "DURATION" or "PATTERN=DURATION,..." where patterns match the cached filenames
+    parsed = []
+    for rule in filter(None, (rule.strip() for rule in rules.split(','))):
+        pattern, _, duration = rule.rpartition('=')
+        parsed.append((pattern or '*', misc.str2Duration(duration)))
+    return parsed
+
+FILES_COLUMNS = dict(
+    cost=f"REAL NOT NULL DEFAULT {DEFAULT_COST}",
+    expires="REAL",
+    priority="REAL NOT NULL DEFAULT 0",
+)
+
+# the total size is kept by triggers, so that it is not summed on every miss
+SIZE_TRIGGERS = dict(
+    files_size_insert="AFTER INSERT ON files BEGIN "
+        "UPDATE meta SET value = value + NEW.size WHERE key = 'total_size'; END",
+    files_size_delete="AFTER DELETE ON files BEGIN "
+        "UPDATE meta SET value = value - OLD.size WHERE key = 'total_size'; END",
+    files_size_update="AFTER UPDATE OF size ON files BEGIN "
+        "UPDATE meta SET value = value + NEW.size - OLD.size WHERE key = 'total_size'; END",
+)
+
+# the index records every cached file, so that opening a cache does not walk it
 class LRUCache(object):
-    def __init__(self, cache_dir, max_cache_size, retrieve_func=None, retrieve_args=[], retrieve_kwargs={}):
+    def __init__(self, cache_dir, max_cache_size, retrieve_func=None, retrieve_args=[], retrieve_kwargs={},
+                 policy='lru', ttl_rules=[], cache_format='jp2'):
+        if policy not in EVICTION_POLICIES:
+            raise Exception(f"Unknown eviction policy {policy}. Valid policies are : {misc.getValid(EVICTION_POLICIES)}")
         self.cache_dir = cache_dir
         self.max_cache_size = max_cache_size
+        self.policy = policy
+        self.ttl_rules = ttl_rules
+        # extension of the rasters stored, see utils.rasterio.CACHE_FORMAT_PROFILES
+        self.cache_format = cache_format
         self.retrieve_func = retrieve_func
         self.retrieve_args = retrieve_args
         self.retrieve_kwargs = retrieve_kwargs
-        self.current_cache_size = 0
         Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
-        self.lru = OrderedDict()
-        self.idx = 0
-        self.fillLru()
+        self.lock_dir = os.path.join(self.cache_dir, LOCK_DIR_NAME)
+        Path(self.lock_dir).mkdir(exist_ok=True)
+        self.index_path = os.path.join(self.cache_dir, INDEX_FILE_NAME)
+        self.db = sqlite3.connect(self.index_path, timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # processes opening the cache together migrate it one after the other
+        with self.immediate():
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS files (fn TEXT PRIMARY KEY, size INTEGER NOT NULL, atime REAL NOT NULL)")
+            columns = {row[1] for row in self.db.execute("PRAGMA table_info(files)")}
+            for column, definition in FILES_COLUMNS.items():
+                if column not in columns:
+                    self.db.execute(f"ALTER TABLE files ADD COLUMN {column} {definition}")
+            self.db.execute("CREATE INDEX IF NOT EXISTS files_priority ON files (priority)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS files_expires ON files (expires)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+            # indexes created before the running total sum it once
+            self.db.execute(
+                "INSERT OR IGNORE INTO meta (key, value) SELECT 'total_size', COALESCE(SUM(size), 0) FROM files")
+            for name, definition in SIZE_TRIGGERS.items():
+                self.db.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {definition}")
+            # files in use by a process, shared so that no process evicts them
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS pins (fn TEXT NOT NULL, pid INTEGER NOT NULL, PRIMARY KEY (fn, pid))")
+        if self.getMeta('policy') != self.policy:
+            self.reprioritize()
+        if not self.getMeta('reconciled'):
+            # caches filled before the index existed are indexed once, by the first process to get there
+            self.reconcile(once=True)
+        self.releaseStalePins()
+        self.pinned = Counter()
+        self.statistics = Counter()
+
+    @property
+    def current_cache_size(self):
+        return self.getMeta('total_size', 0)
 
     def getPath(self):
         return self.cache_dir
 
-    def addFile(self, fn=None, path=None):
+    @contextlib.contextmanager
+    def immediate(self):
+        # a write transaction taken at once, what is read inside it cannot change before the commit
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except:
+            self.db.rollback()
+            raise
+        self.db.commit()
+
+    def getMeta(self, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def setMeta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def priority(self, atime, size, cost):
+        return EVICTION_POLICIES[self.policy](self.getMeta('inflation', 0.), atime, size, cost)
+
+    def reprioritize(self):
+        # the priorities of another policy are meaningless for this one
+        with self.db:
+            self.setMeta('inflation', 0.)
+            self.setMeta('policy', self.policy)
+            self.db.executemany(
+                "UPDATE files SET priority = ? WHERE fn = ?",
+                ((self.priority(atime, size, cost), fn)
+                 for fn, atime, size, cost in self.db.execute("SELECT fn, atime, size, cost FROM files").fetchall()))
+
+    def ttlFor(self, fn):
+        for pattern, ttl in self.ttl_rules:
+            if fnmatch.fnmatch(fn, pattern) or fnmatch.fnmatch(os.path.basename(fn), pattern):
+                return ttl
+        return None
+
+    def addFile(self, fn=None, path=None, atime=None, cost=None, ttl=None):
         if fn is None and path is None:
             raise Exception("At least fn or path should be provided")
         if path is None:
@@ -29,24 +197,168 @@ class LRUCache(object):
         if fn is None:
             fn = os.path.relpath(path, self.cache_dir)
         size = os.path.getsize(path)
-        mtime = os.path.getmtime(path)
-        self.lru[(mtime, self.idx)] = (fn, path, size)
-        self.current_cache_size += size
-        self.idx += 1
+        atime = time.time() if atime is None else atime
+        cost = DEFAULT_COST if cost is None else cost
+        ttl = self.ttlFor(fn) if ttl is None else ttl
+        expires = None if ttl is None else atime + ttl
+        with self.db:
+            # a replace would not fire the delete trigger keeping the total size
+            self.db.execute("DELETE FROM files WHERE fn = ?", (fn,))
+            self.db.execute(
+                "INSERT INTO files (fn, size, atime, cost, expires, priority) VALUES (?, ?, ?, ?, ?, ?)",
+                (fn, size, atime, cost, expires, self.priority(atime, size, cost)))
+
+    def touch(self, fn, path):
+        now = time.time()
+        os.utime(path, (now, now))
+        row = self.db.execute("SELECT size, cost FROM files WHERE fn = ?", (fn,)).fetchone()
+        if row is None:
+            # expired meanwhile by another process, the file stays until it is retrieved again
+            return
+        size, cost = row
+        with self.db:
+            self.db.execute(
+                "UPDATE files SET atime = ?, priority = ? WHERE fn = ?",
+                (now, self.priority(now, size, cost), fn))
+
+    def evictionBatches(self, condition, parameters, order):
+        # read by batches along an index, an eviction pass only reads the files it evicts
+        last = (float('-inf'), -1)
+        while True:
+            rows = self.db.execute(
+                f"SELECT fn, size, priority, {order}, rowid FROM files WHERE {condition} "
+                f"AND fn NOT IN (SELECT fn FROM pins) AND ({order}, rowid) > (?, ?) "
+                f"ORDER BY {order}, rowid LIMIT ?",
+                (*parameters, *last, EVICTION_BATCH)).fetchall()
+            yield from (row[:3] for row in rows)
+            if len(rows) < EVICTION_BATCH:
+                return
+            last = rows[-1][3:]
+
+    def evictionOrder(self):
+        # expired files go first, then by priority
+        now = time.time()
+        yield from self.evictionBatches("expires < ?", (now,), 'expires')
+        yield from self.evictionBatches("(expires IS NULL OR expires >= ?)", (now,), 'priority')
 
     def removeFile(self):
-        _,(_, path, size) = self.lru.popitem(last=False)
-        os.remove(path)
-        self.current_cache_size -= size
+        row = next(self.evictionOrder(), None)
+        if row is not None:
+            self.evict(row[0])
+
+    def pin(self, fn):
+        if not self.pinned[fn]:
+            with self.db:
+                self.db.execute("INSERT OR IGNORE INTO pins (fn, pid) VALUES (?, ?)", (fn, os.getpid()))
+        self.pinned[fn] += 1
+
+    def pinIndexed(self, fn):
+        # the pin and the lookup are one transaction, an eviction removes the row either before both
+        # or not at all, see evict
+        with self.db:
+            self.db.execute("INSERT OR IGNORE INTO pins (fn, pid) VALUES (?, ?)", (fn, os.getpid()))
+            row = self.db.execute("SELECT expires FROM files WHERE fn = ?", (fn,)).fetchone()
+        self.pinned[fn] += 1
+        return row
+
+    def unpin(self, fn):
+        self.pinned[fn] -= 1
+        if self.pinned[fn] <= 0:
+            del self.pinned[fn]
+            with self.db:
+                self.db.execute("DELETE FROM pins WHERE fn = ? AND pid = ?", (fn, os.getpid()))
+
+    def releaseStalePins(self):
+        # pins of processes which died without releasing them
+        pids = [pid for (pid,) in self.db.execute("SELECT DISTINCT pid FROM pins")]
+        with self.db:
+            self.db.executemany(
+                "DELETE FROM pins WHERE pid = ?",
+                ((pid,) for pid in pids if not isProcessAlive(pid)))
+
+    def keyLock(self, fn, blocking=True):
+        return fileLock(os.path.join(self.lock_dir, hashlib.sha1(fn.encode()).hexdigest()), blocking, remove=True)
 
-    def fillLru(self):
+    def evict(self, fn):
+        # a key locked by another process is being retrieved again, it is left alone
+        with self.keyLock(fn, blocking=False) as locked:
+            if not locked:
+                return False
+            # the pins are checked again by the statement removing the row, a file pinned since the
+            # eviction order was read stays
+            with self.db:
+                removed = self.db.execute(
+                    "DELETE FROM files WHERE fn = ? AND fn NOT IN (SELECT fn FROM pins)", (fn,)).rowcount
+            if removed:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(self.cache_dir, fn))
+            return bool(removed)
+
+    def forget(self, fn, delete=False):
+        with self.db:
+            self.db.execute("DELETE FROM files WHERE fn = ?", (fn,))
+        if delete:
+            try:
+                os.remove(os.path.join(self.cache_dir, fn))
+            except FileNotFoundError:
+                pass
+
+    def reconcile(self, once=False):
+        # resynchronize the index with the files on disk, it walks the whole cache
+        on_disk = {}
         for path, subdirs, files in os.walk(self.cache_dir):
+            subdirs[:] = [subdir for subdir in subdirs if subdir != LOCK_DIR_NAME]
             for name in files:
-                self.addFile(path=os.path.join(path, name))
+                if name.startswith(PARTIAL_PREFIX):
+                    continue
+                file_path = os.path.join(path, name)
+                fn = os.path.relpath(file_path, self.cache_dir)
+                if not fn.startswith(INDEX_FILE_NAME):
+                    on_disk[fn] = (os.path.getsize(file_path), os.path.getmtime(file_path))
+        with self.immediate():
+            if once and self.getMeta('reconciled'):
+                return
+            indexed = dict(self.db.execute("SELECT fn, size FROM files"))
+            # files retrieved since the walk are on disk but were not seen
+            self.db.executemany(
+                "DELETE FROM files WHERE fn = ?",
+                ((fn,) for fn in indexed.keys() - on_disk.keys()
+                 if not os.path.exists(os.path.join(self.cache_dir, fn))))
+            self.db.executemany(
+                "INSERT OR IGNORE INTO files (fn, size, atime, cost, expires, priority) VALUES (?, ?, ?, ?, ?, ?)",
+                ((fn, size, mtime, DEFAULT_COST,
+                  None if self.ttlFor(fn) is None else mtime + self.ttlFor(fn),
+                  self.priority(mtime, size, DEFAULT_COST))
+                 for fn, (size, mtime) in on_disk.items() if fn not in indexed))
+            self.db.executemany(
+                "UPDATE files SET size = ? WHERE fn = ?",
+                ((size, fn) for fn, (size, _) in on_disk.items() if fn in indexed and indexed[fn] != size))
+            self.setMeta('reconciled', 1)
 
-    def cleancache(self):
-        while self.current_cache_size > self.max_cache_size and self.lru:
-            self.removeFile()
+    def lookup(self, fn):
+        row = self.db.execute("SELECT fn FROM files WHERE fn = ?", (fn,)).fetchone()
+        return None if row is None else os.path.join(self.cache_dir, fn)
+
+    def cleancache(self, reserve=0, keep=None):
+        # evict the files of lowest priority until reserve more bytes fit
+        size = self.current_cache_size + reserve
+        if size <= self.max_cache_size:
+            return
+        inflation = self.getMeta('inflation', 0.)
+        for fn, file_size, priority in self.evictionOrder():
+            if size <= self.max_cache_size:
+                break
+            if fn == keep or not self.evict(fn):
+                continue
+            size -= file_size
+            inflation = max(inflation, priority)
+            self.statistics['evictions'] += 1
+            self.statistics['evicted_bytes'] += file_size
+        with self.db:
+            self.setMeta('inflation', inflation)
+        if size > self.max_cache_size:
+            warnings.warn(f"{self.cache_dir} exceeds its size by {misc.byteSize2Str(size - self.max_cache_size)}, "
+                          f"every other file is pinned")
 
     def setRetrieve(self, func=None, args=None, kwargs=None):
         if func is not None:
@@ -60,55 +372,151 @@ class LRUCache(object):
                 raise Exception(f"{args} is not a dict")
             self.retrieve_kwargs = kwargs
 
-    def retrieve(self, fn, retrieve_func=None, force_retrieve_func=None, args=[], kwargs={}):
-        #lookup for element. Slow but who cares
-        lookup = misc.getFirstOrNone(
-            (key
-            for key,(f,_,_) in self.lru.items()
-            if f == fn))
-        args = self.retrieve_args + args
-        kwargs |= self.retrieve_kwargs
- 
-        if lookup is not None:
-            (fn,path,size) = self.lru.pop(lookup)
-            self.current_cache_size -= size
-            now = time.time()
-            if (force_retrieve_func is None
-                 or not force_retrieve_func(path, fn, *args, **kwargs)):
-                os.utime(path, (now, now))
-                self.addFile(path=path, fn=fn)
-                return path
+    def cached(self, fn, force_retrieve_func, args, kwargs):
+        # pinned before the file is checked, so that no other process evicts it once found
+        row = self.pinIndexed(fn)
+        path = None if row is None else self.checkCached(fn, row, force_retrieve_func, args, kwargs)
+        if path is not None:
+            self.statistics['hits'] += 1
+        if path is not None and pin_scopes:
+            pin_scopes[-1].append((self, fn))
+        else:
+            self.unpin(fn)
+        return path
+
+    def checkCached(self, fn, row, force_retrieve_func, args, kwargs):
         path = os.path.join(self.cache_dir, fn)
-        self.cleancache()
-        misc.createHierachy(path, is_file=True)
-        try:
-            success = (retrieve_func or self.retrieve_func)(path, fn, *args, **kwargs)
-        except:
+        expires, = row
+        if expires is not None and expires < time.time():
+            self.statistics['expirations'] += 1
+            self.forget(fn)
             return None
-        if not success:
+        if force_retrieve_func is not None and force_retrieve_func(path, fn, *args, **kwargs):
+            self.forget(fn)
+            return None
+        try:
+            self.touch(fn, path)
+        except FileNotFoundError:
+            # removed behind the back of the index
+            self.forget(fn)
             return None
-        self.addFile(path=path, fn=fn)
         return path
 
-bdd = {}
-def fillLRUDb():
-    global bdd
+    def retrieve(self, fn, retrieve_func=None, force_retrieve_func=None, args=[], kwargs={}, expected_size=0,
+                 cost=None, ttl=None, resumable=False):
+        # cost defaults to the time spent retrieving, ttl to the rules of the cache. expected_size makes room
+        # before retrieving, it may be a function only called on a miss. A resumable retrieve_func continues
+        # the partial file left by a failed retrieval, which is kept for it
+        args = self.retrieve_args + args
+        kwargs |= self.retrieve_kwargs
+        path = self.cached(fn, force_retrieve_func, args, kwargs)
+        if path is not None:
+            return path
+
+        # only one process retrieves a key, the others wait for it
+        with self.keyLock(fn):
+            path = self.cached(fn, force_retrieve_func, args, kwargs)
+            if path is not None:
+                return path
+            self.statistics['misses'] += 1
+            path = os.path.join(self.cache_dir, fn)
+            self.cleancache(reserve=(expected_size() if callable(expected_size) else expected_size) or 0)
+            misc.createHierachy(path, is_file=True)
+            # retrieved aside then renamed, so that a path of the cache is always complete
+            partial_path = os.path.join(os.path.dirname(path), PARTIAL_PREFIX + os.path.basename(path))
+            start = timer()
+            try:
+                with profiling.stage('cache.retrieve'):
+                    success = (retrieve_func or self.retrieve_func)(partial_path, fn, *args, **kwargs)
+                if success:
+                    os.replace(partial_path, path)
+            except:
+                success = False
+            finally:
+                # left by a failed retrieval
+                if not resumable:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(partial_path)
+            if not success:
+                self.statistics['failures'] += 1
+                return None
+            self.addFile(path=path, fn=fn, cost=timer() - start if cost is None else cost, ttl=ttl)
+            pinScope(self, fn)
+        self.statistics['retrieved_bytes'] += os.path.getsize(path)
+        # the actual size is only known now
+        self.cleancache(keep=fn)
+        return path
+
+pin_scopes = []
+
+@contextlib.contextmanager
+def pinning():
+    # files retrieved inside the scope cannot be evicted until it ends
+    pinned = []
+    pin_scopes.append(pinned)
+    try:
+        yield
+    finally:
+        pin_scopes.pop()
+        for cache, fn in pinned:
+            cache.unpin(fn)
+
+def pinScope(cache, fn):
+    if pin_scopes:
+        cache.pin(fn)
+        pin_scopes[-1].append((cache, fn))
+
+# every variable is read from PREFIX_DIR, PREFIX_SIZE, PREFIX_POLICY, PREFIX_TTL and PREFIX_FORMAT
+LRU_CONFIGURATIONS = {
+    'sentinel2L2A' : misc.dotdict(prefix='SENT2_L2A_CACHE', dir='sentinel2-l2a-cache', size='256G', policy='lru', ttl='', format='jp2'),
+    'sentinel2L1C' : misc.dotdict(prefix='SENT2_L1C_CACHE', dir='sentinel2-l1c-cache', size='64G', policy='lru', ttl='', format='jp2'),
+    'gmt'          : misc.dotdict(prefix='GMT_CACHE', dir='gmt-cache', size='16G', policy='cost',
+                                  ttl='gmt_data_server.txt=1d,index.html=7d', format='jp2'),
+    'sentinel2CLD' : misc.dotdict(prefix='SENT2_CLD_CACHE', dir='sentinel2-cld-cache', size='32G', policy='cost', ttl='', format='tif'),
+}
+
+def makeLRU(lru_name):
     dotenv.load_dotenv()
     base = os.environ.get('CACHE_DIR', 'cache')
-    data = (
-        ('sentinel2L2A', 'SENT2_L2A_CACHE_DIR', 'sentinel2-l2a-cache', 'SENT2_L2A_CACHE_SIZE', '256G'),
-        ('sentinel2L1C', 'SENT2_L1C_CACHE_DIR', 'sentinel2-l1c-cache', 'SENT2_L1C_CACHE_SIZE', '64G'),
-        ('gmt',          'GMT_CACHE_DIR',       'gmt-cache',           'GMT_CACHE_SIZE',       '16G'),
-        ('sentinel2CLD', 'SENT2_CLD_CACHE_DIR', 'sentinel2-cld-cache', 'SENT2_CLD_CACHE_SIZE', '32G'),
+    configuration = LRU_CONFIGURATIONS[lru_name]
+    def env(suffix):
+        return os.environ.get(f"{configuration.prefix}_{suffix}", configuration[suffix.lower()])
+    return LRUCache(
+        cache_dir=os.path.join(base, env('DIR')),
+        max_cache_size=misc.str2ByteSize(env('SIZE')),
+        policy=env('POLICY'),
+        ttl_rules=parseTtlRules(env('TTL')),
+        cache_format=env('FORMAT'),
     )
-    for key, cache_dir, cache_dir_default, cache_size, cache_size_default in data:
-        bdd[key] = LRUCache(
-            cache_dir=os.path.join(base, os.environ.get(cache_dir, cache_dir_default)),
-            max_cache_size=misc.str2ByteSize(os.environ.get(cache_size, cache_size_default)),
-        )
 
+# caches are only scanned when a driver needs them
+bdd = {}
 def get(lru_name):
     global bdd
+    if lru_name not in bdd:
+        bdd[lru_name] = makeLRU(lru_name)
     return bdd[lru_name]
 
-fillLRUDb()
+def statistics():
+    return {lru_name:Counter(cache.statistics) for lru_name, cache in bdd.items()}
+
+def statisticsSince(snapshot):
+    deltas = {
+        lru_name:dict(counters - snapshot.get(lru_name, Counter()))
+        for lru_name, counters in statistics().items()}
+    return {lru_name:delta for lru_name, delta in deltas.items() if delta}
+
+def sumStatistics(all_statistics):
+    total = {}
+    for lru_statistics in all_statistics:
+        for lru_name, counters in lru_statistics.items():
+            total.setdefault(lru_name, Counter()).update(counters)
+    return {lru_name:dict(counters) for lru_name, counters in total.items()}
+
+def main(argv):
+    # reconcile the indexes with the disk, for caches modified by hand
+    for lru_name in argv[1:] or LRU_CONFIGURATIONS.keys():
+        cache = get(lru_name)
+        print(f"Reconciling {lru_name} in {cache.getPath()}")
+        cache.reconcile()
+        print(f"-- {misc.byteSize2Str(cache.current_cache_size)} indexed")
@@ -0,0 +1,38 @@
+import os
+import json
+import hashlib
+
+MANIFEST_FILE_NAME = "manifest.json"
+STARTED = "started"
+DONE = "done"
+FAILED = "failed"
+
+def hashParameters(**parameters):
+    serialized = json.dumps(parameters, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+class RunManifest(object):
+    def __init__(self, output):
+        self.output = output
+        self.path = os.path.join(output, MANIFEST_FILE_NAME)
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f).get('tiles', {})
+
+    def isComplete(self, filename, digest):
+        entry = self.entries.get(filename)
+        return (entry is not None
+                and entry['state'] == DONE
+                and entry['hash'] == digest
+                and os.path.exists(os.path.join(self.output, filename)))
+
+    def mark(self, filename, digest, state, **extra):
+        self.entries[filename] = dict(hash=digest, state=state, **extra)
+
+    def save(self):
+        # write aside then rename, a crash never leaves a truncated manifest
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'tiles': self.entries}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
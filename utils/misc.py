@@ -21,9 +21,11 @@ warnings.warn('cleanup options')
 valid_options = {
 'raster_layer' : {
     "fillnodata": {"real_option":"fillNoData","documentation":"replace nodata value by neighboring valid values"},
-    "scale01": {"real_option":"scale01","documentation":"scale integer to range 0 1 while reading int8 or int16"},
-    "scale11": {"real_option":"scale11","documentation":"scale integer to range -1 1 while reading int8 or int16"},
+    "scale01": {"real_option":"scale01","documentation":"scale integer to range 0 1 while reading int8 or int16. scale01=MIN,MAX scales float bands from MIN,MAX, required with several tiles"},
+    "scale11": {"real_option":"scale11","documentation":"scale integer to range -1 1 while reading int8 or int16. scale11=MIN,MAX scales float bands from MIN,MAX, required with several tiles"},
     "resampling": {"real_option":"resampling","documentation":"algorithm used for resampling"},
+    "blocksize": {"real_option":"block_size","documentation":"warp and write by blocks of BLOCKSIZExBLOCKSIZE pixels, bounding the memory used whatever the tile size"},
+    "fullresolution": {"real_option":"full_resolution","documentation":"read the sources at full resolution, instead of their overviews or jpeg2000 resolution levels when downsampling"},
 },
 'rasterize' : {
     "nodata": {"real_option":"noData","documentation":"nodata value"},
@@ -37,8 +39,8 @@ valid_options = {
     "sqldialect": {"real_option":"SQLDialect","documentation":"SQL dialect (‘OGRSQL’, ‘SQLITE’, …)"},
     "where": {"real_option":"where","documentation":"WHERE clause to apply to source layer(s)"},
     "optim": {"real_option":"optim","documentation":"optimization mode (‘RASTER’, ‘VECTOR’)"},
-    "scale01": {"real_option":"scale01","documentation":"scale integer to range 0 1 while reading int8 or int16"},
-    "scale11": {"real_option":"scale11","documentation":"scale integer to range -1 1 while reading int8 or int16"},
+    "scale01": {"real_option":"scale01","documentation":"scale integer to range 0 1 while reading int8 or int16. scale01=MIN,MAX scales float bands from MIN,MAX, required with several tiles"},
+    "scale11": {"real_option":"scale11","documentation":"scale integer to range -1 1 while reading int8 or int16. scale11=MIN,MAX scales float bands from MIN,MAX, required with several tiles"},
     "defaultvalue": {"real_option":"default_value"},
     "fill": {"real_option":"fill"},
 },
@@ -71,6 +73,14 @@ str_to_byte_size = {
     't' : 1000_000_000_000,
 }
 
+str_to_seconds = {
+    'w' : 604800,
+    'd' : 86400,
+    'h' : 3600,
+    'm' : 60,
+    's' : 1,
+}
+
 str_to_arcsec = {
     'd' : 3600,
     'm' : 60,
@@ -134,7 +144,7 @@ def str2IntMultiplier(arg, l):
     r = re.compile(r"([\d'_]+(?:\.\d+)?)(.*)")
     result = r.fullmatch(arg)
     if not result:
-        raise Exception(f"Invalid value : '{arg}'")
+        raise ValueError(f"Invalid value : '{arg}'")
 
     mantissa, exponent = result.groups()
 
@@ -143,7 +153,7 @@ def str2IntMultiplier(arg, l):
 
     if exponent_str:
         if exponent_str.lower() not in l:
-            raise Exception(f"Unknown multiplier : '{exponent_str}'. Valid multipliers are : {getValid(l)}")
+            raise ValueError(f"Unknown multiplier : '{exponent_str}'. Valid multipliers are : {getValid(l)}")
         mantissa = mantissa * l[exponent_str.lower()]
     return mantissa
 
@@ -153,9 +163,35 @@ def ceildivide(a,b):
 def str2ByteSize(arg):
     return int(str2IntMultiplier(arg, str_to_byte_size))
 
+def byteSize2Str(size):
+    for unit, multiplier in reversed(str_to_byte_size.items()):
+        if size >= multiplier:
+            return f"{size / multiplier:.1f}{unit.upper()}"
+    return f"{size}"
+
 def str2Arcsec(arg):
     return str2IntMultiplier(arg, str_to_arcsec)
 
+def str2Duration(arg):
+    return str2IntMultiplier(arg, str_to_seconds)
+
+def str2Threads(arg):
+    # a count of threads, ALL_CPUS, or auto to share the cpus between the jobs
+    if str(arg).upper() == 'AUTO':
+        return 'auto'
+    if str(arg).upper() == 'ALL_CPUS':
+        return 'ALL_CPUS'
+    threads = int(arg)
+    if threads < 1:
+        raise ValueError(f"Invalid thread count : '{arg}'")
+    return threads
+
+def str2NonNegativeFloat(arg):
+    value = float(arg)
+    if value < 0:
+        raise ValueError(f"Negative value : '{arg}'")
+    return value
+
 def bytes2StrYield(stream):
     for a in stream:
         yield a.decode('utf-8')
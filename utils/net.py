@@ -1,7 +1,6 @@
 import utils.misc as misc
 import os
 import shutil
-from tqdm.std import tqdm
 import urllib.request
 
 gmt_servers = misc.dotdict(
@@ -48,6 +47,7 @@ def getBestGMTServer():
 
 def fetchFromInternet(path, url, desc=None):
     desc = os.path.basename(path) if desc is None else desc
+    from tqdm.std import tqdm
     with urllib.request.urlopen(url) as response, open(path, 'wb') as f:
         with tqdm.wrapattr(
                 f,
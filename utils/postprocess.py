@@ -0,0 +1,138 @@
+import numpy as np
+import utils.misc as misc
+
+POSTPROCESS_OPTIONS = ('fillnodata', 'scale01', 'scale11')
+SCALE_TARGETS = {
+    'scale01': (0., 1.),
+    'scale11': (-1., 1.),
+}
+
+def splitOptions(options):
+    # post processing options are removed from the ones given to the driver
+    found = {key:options.pop(key) for key in POSTPROCESS_OPTIONS if key in options}
+    scales = [key for key in SCALE_TARGETS if key in found]
+    if len(scales) > 1:
+        raise Exception(f"{' and '.join(scales)} are mutually exclusive")
+    postprocess = misc.dotdict(
+        fill_nodata='fillnodata' in found,
+        nodata=None,
+        scale=None,
+        scale_range=None)
+    if found.get('fillnodata') is not None:
+        postprocess.nodata = float(found['fillnodata'])
+    if scales:
+        postprocess.scale = SCALE_TARGETS[scales[0]]
+        if found[scales[0]] is not None:
+            postprocess.scale_range = tuple(map(float, found[scales[0]].split(',')))
+            if len(postprocess.scale_range) != 2:
+                raise Exception(f"{scales[0]} expects MIN,MAX")
+    return postprocess
+
+def checkTiledScale(postprocess, layer_name):
+    # the range of a tile is its own minimum and maximum, neighbouring tiles would not match
+    if postprocess.scale is not None and postprocess.scale_range is None:
+        raise Exception(f"Layer {layer_name} is rendered in several tiles, "
+                        f"its scale needs a MIN,MAX range such as scale01=MIN,MAX")
+
+class Buffers(object):
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, name, shape, dtype):
+        size = int(np.prod(shape))
+        dtype = np.dtype(dtype)
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.dtype != dtype or buffer.size < size:
+            buffer = np.empty(size, dtype=dtype)
+            self.buffers[name] = buffer
+        return buffer[:size].reshape(shape)
+
+# reused from tile to tile, so that post processing does not allocate full size arrays
+buffers = Buffers()
+
+def estimateMemory(postprocess, width, height, dtype):
+    # buffers of apply : the band read whole and the valid mask, plus the values and the index of the fill
+    if not postprocess or not (postprocess.fill_nodata or postprocess.scale):
+        return 0
+    itemsize = np.dtype(dtype).itemsize
+    per_pixel = itemsize + np.dtype(bool).itemsize
+    if postprocess.fill_nodata:
+        per_pixel += itemsize + np.dtype(np.intp).itemsize
+    return width * height * per_pixel
+
+def validMask(band, nodata, out):
+    if np.isnan(nodata):
+        np.isnan(band, out=out)
+        return np.logical_not(out, out=out)
+    return np.not_equal(band, nodata, out=out)
+
+def propagate(band, valid, axis, reverse):
+    rows, cols = band.shape
+    length = band.shape[axis]
+    values = buffers.get('values', band.shape, band.dtype)
+    index = buffers.get('index', band.shape, np.intp)
+    positions = np.arange(length).reshape((-1, 1) if axis == 0 else (1, -1))
+    values[...] = band
+    # position of the last valid pixel met, or of the first pixel that stays nodata
+    if reverse:
+        np.multiply(valid, positions - (length - 1), out=index)
+        index += length - 1
+        flipped = np.flip(index, axis=axis)
+        np.minimum.accumulate(flipped, axis=axis, out=flipped)
+    else:
+        np.multiply(valid, positions, out=index)
+        np.maximum.accumulate(index, axis=axis, out=index)
+    if axis == 0:
+        index *= cols
+        index += np.arange(cols).reshape(1, -1)
+    else:
+        index += (np.arange(rows) * cols).reshape(-1, 1)
+    np.take(values.reshape(-1), index, out=band, mode='clip')
+
+def fillNoData(band, nodata):
+    valid = buffers.get('valid', band.shape, bool)
+    for axis in (1, 0):
+        for reverse in (False, True):
+            validMask(band, nodata, valid)
+            propagate(band, valid, axis, reverse)
+
+def scale(band, nodata, target, scale_range=None):
+    if not np.issubdtype(band.dtype, np.floating):
+        raise Exception(f"impossible to scale a band of type {band.dtype}, use a float dtype")
+    valid = buffers.get('valid', band.shape, bool)
+    if nodata is None:
+        valid[...] = True
+    else:
+        validMask(band, nodata, valid)
+    if scale_range is None:
+        scale_range = (
+            np.min(band, where=valid, initial=np.inf),
+            np.max(band, where=valid, initial=-np.inf))
+    (min_src, max_src), (min_dst, max_dst) = scale_range, target
+    if not max_src > min_src:
+        print(f"--   empty range {scale_range}, not scaling")
+        return
+    band -= min_src
+    band *= (max_dst - min_dst) / (max_src - min_src)
+    band += min_dst
+    if nodata is not None:
+        np.logical_not(valid, out=valid)
+        np.copyto(band, band.dtype.type(nodata), where=valid)
+
+def apply(dst_ds, postprocess):
+    if not postprocess or not (postprocess.fill_nodata or postprocess.scale):
+        return dst_ds
+    nodata = postprocess.nodata if postprocess.nodata is not None else dst_ds.nodata
+    if postprocess.fill_nodata and nodata is None:
+        raise Exception("fillnodata needs a value when the dataset has no nodata")
+    band = buffers.get('band', dst_ds.shape, dst_ds.dtypes[0])
+    for idx in range(1, dst_ds.count + 1):
+        dst_ds.read(idx, out=band)
+        if postprocess.fill_nodata:
+            print(f"-- patching holes in band {idx}")
+            fillNoData(band, nodata)
+        if postprocess.scale:
+            print(f"-- scaling band {idx} to {list(postprocess.scale)}")
+            scale(band, nodata, postprocess.scale, postprocess.scale_range)
+        dst_ds.write(band, idx)
+    return dst_ds
@@ -1,18 +1,20 @@
 import os
 import subprocess
+import utils.profiling as profiling
 
 def execute(*args, env={}, **kwargs):
     print('gdalwarp', *args)
     env = os.environ | env | {
         'LD_LIBRARY_PATH':f'/home/elie/.local/lib:{os.environ.get("LD_LIBRARY_PATH")}',
         'PATH':f'/home/elie/.local/bin:{os.environ.get("PATH", None)}'}
-    return subprocess.run(*args,env=env,**kwargs)
+    with profiling.stage(f'process.{args[0][0]}'):
+        return subprocess.run(*args,env=env,**kwargs)
 
 def gdal_translate(*args, **kwargs):
-    execute(['gdal_translate',*args], stdout=subprocess.PIPE, **kwargs)
+    return execute(['gdal_translate',*args], stdout=subprocess.PIPE, **kwargs)
 
 def gdal_buildvrt(*args, **kwargs):
-    execute(['gdalbuildvrt',*args], stdout=subprocess.PIPE, **kwargs)
+    return execute(['gdalbuildvrt',*args], stdout=subprocess.PIPE, **kwargs)
 
 def gdal_warp(*args, **kwargs):
-    execute(['gdalwarp',*args], stdout=subprocess.PIPE, **kwargs)
+    return execute(['gdalwarp',*args], stdout=subprocess.PIPE, **kwargs)
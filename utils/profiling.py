@@ -0,0 +1,72 @@
+import os
+import json
+import cProfile
+import contextlib
+from collections import defaultdict
+from timeit import default_timer as timer
+
+class StageTimer(object):
+    def __init__(self):
+        self.durations = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    def record(self, name, duration):
+        self.durations[name] += duration
+        self.counts[name] += 1
+
+    def asDict(self):
+        return {
+            name:{'duration':self.durations[name], 'count':self.counts[name]}
+            for name in sorted(self.durations)}
+
+stage_timers = []
+
+@contextlib.contextmanager
+def collect():
+    stage_timer = StageTimer()
+    stage_timers.append(stage_timer)
+    try:
+        yield stage_timer
+    finally:
+        stage_timers.pop()
+
+@contextlib.contextmanager
+def stage(name):
+    # stages nest, the time of a stage includes the time of the stages inside it
+    start = timer()
+    try:
+        yield
+    finally:
+        if stage_timers:
+            stage_timers[-1].record(name, timer() - start)
+
+@contextlib.contextmanager
+def profileTo(path):
+    if path is None:
+        yield None
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+
+def summarize(records, key):
+    summary = defaultdict(lambda: defaultdict(lambda: {'duration':0., 'count':0}))
+    for record in records:
+        for name, stage_time in record['stages'].items():
+            summary[record[key]][name]['duration'] += stage_time['duration']
+            summary[record[key]][name]['count'] += stage_time['count']
+    return {k:dict(sorted(v.items())) for k, v in sorted(summary.items(), key=lambda x:str(x[0]))}
+
+def writeReport(path, records, **extra):
+    report = dict(
+        extra,
+        per_layer=summarize(records, 'layer'),
+        per_tile=summarize(records, 'tile_id'),
+        records=sorted(records, key=lambda record:(record['tile_id'], str(record['layer']))))
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True, default=str)
+    return path
@@ -1,18 +1,64 @@
 import utils.geo
+import utils.handles
+import utils.profiling as profiling
 import rasterio as rio
 import numpy as np
 
 from utils.misc import str2Resampling
+import utils.misc as misc
 from rasterio import vrt, merge, features, warp
 from rasterio.io import MemoryFile
 from rasterio.enums import Resampling
 from rasterio.drivers import raster_driver_extensions, is_blacklisted
 
+import os
 import warnings
+from utils.process import gdal_buildvrt, gdal_warp, gdal_translate
 from timeit import default_timer as timer
 import contextlib
+from xml.etree import ElementTree
+from shapely import box
 
 LOSSLESS_JPEG2000 = dict(QUALITY=100, REVERSIBLE='YES',TILED='YES',COMPRESS='DEFLATE')
+COG_EXTENSIONS = ('tif', 'tiff')
+COG_COMPRESSIONS = ('NONE', 'LZW', 'DEFLATE', 'ZSTD', 'LZMA', 'LERC', 'LERC_DEFLATE', 'LERC_ZSTD', 'WEBP', 'JPEG')
+COG_PREDICTORS = ('YES', 'NO', 'STANDARD', 'FLOATING_POINT')
+COG_OVERVIEW_RESAMPLINGS = ('nearest', 'average', 'bilinear', 'cubic', 'cubic_spline', 'lanczos', 'mode', 'rms')
+
+def cogProfile(compress='DEFLATE', predictor='YES', blocksize=512, overview_resampling='average'):
+    # the COG driver only copies, rasterio buffers the tile and builds blocks and overviews on close
+    return dict(
+        driver='COG',
+        BLOCKSIZE=blocksize,
+        COMPRESS=compress,
+        PREDICTOR=predictor,
+        OVERVIEWS='AUTO',
+        OVERVIEW_RESAMPLING=overview_resampling.replace('_', '').upper(),
+        BIGTIFF='IF_SAFER')
+
+def translateOptions(profile):
+    profile = dict(profile)
+    return ['-of', profile.pop('driver'), *(arg for key, value in profile.items() for arg in ('-co', f'{key}={value}'))]
+
+# formats in which the caches store rasters, jpeg2000 keeps the conversion deduced by gdal.
+# A tiled geotiff with overviews is larger but decodes only the blocks and the level read
+CACHE_FORMAT_PROFILES = dict(
+    jp2=None,
+    tif=cogProfile(compress='DEFLATE', predictor='YES') | dict(LEVEL=1),
+)
+
+def transcode(src, dst, cache_format, *args):
+    # returns whether dst was written, for the retrieve functions of the caches
+    if cache_format not in CACHE_FORMAT_PROFILES:
+        raise Exception(f"Unknown cache format {cache_format}. Valid formats are : {', '.join(CACHE_FORMAT_PROFILES)}")
+    profile = CACHE_FORMAT_PROFILES[cache_format]
+    options = [] if profile is None else translateOptions(profile)
+    result = gdal_translate(src, dst, *options, *args)
+    if result.returncode:
+        print(f"-- gdal_translate failed on {src} with code {result.returncode}")
+        return False
+    return True
+
 def temporarydataset(
         width,
         height,
@@ -39,7 +85,238 @@ def temporarydataset(
         )
     return ds
 
-def warpmerge(filenames, dst_ds, bands=None, resampling=None, **kwargs):
+# gdal settings of a run. cache_size is in bytes, error_threshold is the error allowed to the approximate
+# transformer of the warps in pixels (0 is exact), threads may be 'auto' to share the cpus between the jobs
+PERFORMANCE_PROFILES = {
+    'default' : misc.dotdict(cache_size=None, warp_threads=None, error_threshold=None, jp2_threads=None),
+    'fast-preview' : misc.dotdict(cache_size=1000_000_000, warp_threads='auto', error_threshold=1., jp2_threads='auto'),
+    'exact' : misc.dotdict(cache_size=512_000_000, warp_threads='auto', error_threshold=0., jp2_threads='auto'),
+}
+PERFORMANCE_SETTINGS = ('cache_size', 'warp_threads', 'error_threshold', 'jp2_threads')
+
+# converters of the settings, shared with the command line options
+PERFORMANCE_CONVERTERS = dict(
+    cache_size=misc.str2ByteSize,
+    warp_threads=misc.str2Threads,
+    error_threshold=misc.str2NonNegativeFloat,
+    jp2_threads=misc.str2Threads,
+)
+
+def str2PerformanceProfile(name):
+    if name.lower() not in PERFORMANCE_PROFILES:
+        raise ValueError(f"Unknown performance profile : '{name}'")
+    return name.lower()
+
+def performanceProfile(name, jobs=1, **overrides):
+    name = str2PerformanceProfile(name)
+    profile = misc.dotdict(PERFORMANCE_PROFILES[name], **{key:value for key, value in overrides.items() if value is not None})
+    for key, converter in PERFORMANCE_CONVERTERS.items():
+        if isinstance(profile[key], str):
+            profile[key] = converter(profile[key])
+    threads = max(1, (os.cpu_count() or 1) // max(1, jobs))
+    for key in ('warp_threads', 'jp2_threads'):
+        if profile[key] == 'auto':
+            profile[key] = threads
+    return misc.dotdict(profile, name=name)
+
+# warp settings of the current profile, read when a warped vrt is created
+warp_settings = misc.dotdict(error_threshold=None, warp_threads=None)
+
+# size of the block cache given to gdal by this process
+gdal_cache_size = None
+
+def applyCacheSize(profile):
+    # gdal reads GDAL_CACHEMAX at the first use of its block cache and ignores it afterwards,
+    # it is set once per process before rendering
+    global gdal_cache_size
+    if profile.cache_size is None or profile.cache_size == gdal_cache_size:
+        return
+    if gdal_cache_size is not None:
+        print(f"-- GDAL cache already set to {misc.byteSize2Str(gdal_cache_size)} in this process, "
+              f"{misc.byteSize2Str(profile.cache_size)} is ignored")
+        return
+    # above 100000, gdal reads the value in bytes
+    rio.env.set_gdal_config('GDAL_CACHEMAX', str(max(int(profile.cache_size), 100_001)))
+    gdal_cache_size = profile.cache_size
+
+@contextlib.contextmanager
+def performanceEnv(profile):
+    # the settings read each time gdal opens, warps or encodes
+    options = {}
+    if profile.jp2_threads is not None:
+        # the openjpeg driver decodes and encodes with GDAL_NUM_THREADS
+        options['GDAL_NUM_THREADS'] = str(profile.jp2_threads)
+    previous = misc.dotdict(warp_settings)
+    warp_settings.update(error_threshold=profile.error_threshold, warp_threads=profile.warp_threads)
+    try:
+        with rio.Env(**options):
+            yield
+    finally:
+        warp_settings.update(previous)
+
+# the datasets of a scope are leased from the handle pool of the process, they stay open for the
+# following scopes until the pool needs their descriptors
+class SharedDatasets(object):
+    def __init__(self, pool=None):
+        self.pool = utils.handles.handlePool() if pool is None else pool
+        self.leases = {}
+        self.memo = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def lease(self, key):
+        if key not in self.leases:
+            self.leases[key] = self.pool.acquire(key)
+        return self.leases[key]
+
+    def open(self, filename, overview_level=None):
+        return self.lease(('raster', filename, overview_level))
+
+    def warp(self, filename, crs, resampling, overview_level=None):
+        return self.lease((
+            'warp', filename, overview_level, crs, resampling,
+            warp_settings.error_threshold, warp_settings.warp_threads))
+
+    def memoize(self, key, func):
+        if key not in self.memo:
+            self.memo[key] = func()
+        return self.memo[key]
+
+    def close(self):
+        for key in self.leases:
+            self.pool.release(key)
+        self.leases.clear()
+        self.memo.clear()
+
+shared_datasets = []
+
+@contextlib.contextmanager
+def sharedDatasets():
+    with SharedDatasets() as datasets:
+        shared_datasets.append(datasets)
+        try:
+            yield datasets
+        finally:
+            shared_datasets.pop()
+
+def currentSharedDatasets():
+    return shared_datasets[-1] if shared_datasets else None
+
+def sharedMemoize(key, func):
+    datasets = currentSharedDatasets()
+    if datasets is None:
+        return func()
+    return datasets.memoize(key, func)
+
+# bounds and crs of the sources, so that most of them are discarded without being opened
+source_footprints = {}
+projected_footprints = {}
+
+def recordFootprint(filename, bounds, crs):
+    source_footprints[filename] = (os.path.getmtime(filename), tuple(bounds), crs)
+
+def sourceFootprint(filename):
+    footprint = source_footprints.get(filename)
+    if footprint is None or footprint[0] != os.path.getmtime(filename):
+        with profiling.stage('warpmerge.footprint'):
+            # through the pool, the sources kept are read with the same handle
+            pool = utils.handles.handlePool()
+            key = ('raster', filename, None)
+            ds = pool.acquire(key)
+            try:
+                recordFootprint(filename, ds.bounds, ds.crs)
+            finally:
+                pool.release(key)
+    return source_footprints[filename]
+
+def projectedFootprint(filename, crs):
+    mtime, bounds, src_crs = sourceFootprint(filename)
+    key = (filename, mtime, crs.to_string())
+    if key not in projected_footprints:
+        projected_footprints[key] = utils.geo.projectBounds(bounds, crs, src_crs)
+    return projected_footprints[key]
+
+def overviewLevel(src_ds, dst_ds):
+    # coarsest overview, or jpeg2000 resolution level, still as fine as the destination pixels
+    factors = src_ds.overviews(1)
+    if not factors:
+        return None
+    minx, miny, maxx, maxy = warp.transform_bounds(dst_ds.crs, src_ds.crs, *dst_ds.bounds)
+    src_res_x, src_res_y = src_ds.res
+    downsampling = min(
+        (maxx - minx) / dst_ds.width / src_res_x,
+        (maxy - miny) / dst_ds.height / src_res_y)
+    level = None
+    for idx, factor in enumerate(factors):
+        if factor <= downsampling:
+            level = idx
+    return level
+
+def windowBox(dst_ds, window):
+    # widened by a pixel, for the sources read by the resampling kernel
+    minx, miny, maxx, maxy = rio.windows.bounds(window, dst_ds.transform)
+    margin_x, margin_y = map(abs, dst_ds.res)
+    return box(minx - margin_x, miny - margin_y, maxx + margin_x, maxy + margin_y)
+
+def blockWindows(dst_ds, block_size=None):
+    if block_size is None:
+        yield rio.windows.Window(0, 0, dst_ds.width, dst_ds.height)
+        return
+    for row in range(0, dst_ds.height, block_size):
+        for col in range(0, dst_ds.width, block_size):
+            yield rio.windows.Window(
+                col,
+                row,
+                min(block_size, dst_ds.width - col),
+                min(block_size, dst_ds.height - row))
+
+def mergeWindow(warped, dst_ds, window, indexes, resampling, **kwargs):
+    kwargs.setdefault('res', dst_ds.res)
+    dest, _ = merge.merge(
+        warped,
+        bounds=rio.windows.bounds(window, dst_ds.transform),
+        resampling=resampling,
+        indexes=indexes,
+        dtype=np.float32,
+        **kwargs)
+    # merge rounds the output shape from the bounds, stick to the window
+    height, width = int(window.height), int(window.width)
+    if dest.shape[1:] != (height, width):
+        fitted = np.zeros((dest.shape[0], height, width), dtype=dest.dtype)
+        h = min(height, dest.shape[1])
+        w = min(width, dest.shape[2])
+        fitted[:, :h, :w] = dest[:, :h, :w]
+        dest = fitted
+    return dest
+
+# merge.merge allocates a float32 destination and a float32 read buffer, each with a mask, for every band
+WARP_BYTES_PER_PIXEL = 2 * (np.dtype(np.float32).itemsize + 1)
+
+def estimateWarpMemory(width, height, count, dtype, block_size=None):
+    output = width * height * count * np.dtype(dtype).itemsize
+    if block_size is None:
+        block_pixels = width * height
+    else:
+        block_size = int(block_size)
+        block_pixels = min(width, block_size) * min(height, block_size)
+    return output + block_pixels * count * WARP_BYTES_PER_PIXEL
+
+def rescaleRanges(src_dtypes, dst_dtype):
+    # integer bands are stretched from the range of their dtype to the one of the destination
+    dst_dtype = np.dtype(dst_dtype)
+    if not np.issubdtype(dst_dtype, np.integer):
+        return []
+    return [
+        (idx, np.iinfo(src_dtype).min, np.iinfo(src_dtype).max, np.iinfo(dst_dtype).min, np.iinfo(dst_dtype).max)
+        for idx, src_dtype in enumerate(map(np.dtype, src_dtypes))
+        if src_dtype != dst_dtype and np.issubdtype(src_dtype, np.integer)]
+
+def warpmerge(filenames, dst_ds, bands=None, resampling=None, block_size=None, full_resolution=False, **kwargs):
+    # full_resolution is a flag of the layer, given without value
     src_bands = list(range(1, dst_ds.count + 1))
     dst_bands = src_bands if bands is None else bands
 
@@ -47,75 +324,193 @@ def warpmerge(filenames, dst_ds, bands=None, resampling=None, **kwargs):
     if isinstance(resampling, str):
         resampling = str2Resampling(resampling)
     resampling_str = resampling.name
+    if block_size is not None:
+        block_size = int(block_size)
+    with profiling.stage('warpmerge.filter'):
+        footprints = {filename:projectedFootprint(filename, dst_ds.crs) for filename in filenames}
+        tile_box = windowBox(dst_ds, rio.windows.Window(0, 0, dst_ds.width, dst_ds.height))
+        kept = [filename for filename in filenames if footprints[filename].intersects(tile_box)]
+    if len(kept) < len(filenames):
+        print(f'--       {len(filenames) - len(kept)} of {len(filenames)} sources do not overlap the tile')
+    filenames = kept
     if not filenames:
-        out = np.zeros(dst_ds.shape, dtype=dst_ds.dtypes[0])
-        dst_ds.write(out, range(1,1+dst_ds.count))
+        for window in blockWindows(dst_ds, block_size):
+            out = np.zeros((dst_ds.count, int(window.height), int(window.width)), dtype=dst_ds.dtypes[0])
+            dst_ds.write(out, range(1,1+dst_ds.count), window=window)
         return dst_ds
 
     with contextlib.ExitStack() as stack:
+        datasets = currentSharedDatasets()
+        if datasets is None:
+            datasets = stack.enter_context(SharedDatasets())
 #        print(f'-- warping {",".join(filenames)} into {dst_ds.name} with crs "{dst_ds.crs}" with bounds "{dst_ds.bounds}"')
         args = ['gdalwarp', '-t_srs', dst_ds.crs, *filenames, dst_ds.name]
         args_str = map(lambda x:f"'{x}'",args)
         # print(' '.join(args_str))
-        dss = [
-            stack.enter_context(
-                rio.open(filename))
-            for filename in filenames]
-        warped = [
-            stack.enter_context(
-                vrt.WarpedVRT(
-                    ds,
-                    crs=dst_ds.crs,
+        # every band is merged at once, the sources are read and warped a single time
+        src_bands, dst_bands = map(list, zip(*zip(src_bands, dst_bands)))
+        with profiling.stage('warpmerge.open'):
+            first_ds = datasets.open(filenames[0])
+        rescale_ranges = rescaleRanges(
+            (first_ds.dtypes[src_band - 1] for src_band in src_bands),
+            dst_ds.dtypes[0])
+        for idx, min_src, max_src, min_dst, max_dst in rescale_ranges:
+            print(f'--       Rescaling band {src_bands[idx]} from [{min_src},{max_src}] to [{min_dst},{max_dst}]')
+        if block_size is not None:
+            print(f'--       Warping by blocks of {block_size}x{block_size}')
+        print(f'--       Warping bands {src_bands} into {dst_bands}')
+
+        overview_levels = {}
+        def warpSource(filename):
+            if filename not in overview_levels:
+                with profiling.stage('warpmerge.overview'):
+                    overview_levels[filename] = (
+                        None if full_resolution is not False
+                        else overviewLevel(datasets.open(filename), dst_ds))
+                if overview_levels[filename] is not None:
+                    print(f'--       Reading {filename} from its overview {overview_levels[filename]}')
+            return datasets.warp(filename, dst_ds.crs, resampling, overview_levels[filename])
+
+        for window in blockWindows(dst_ds, block_size):
+            window_box = windowBox(dst_ds, window)
+            # sources are only opened by the first block they overlap
+            block_filenames = [filename for filename in filenames if footprints[filename].intersects(window_box)]
+            if not block_filenames:
+                with profiling.stage('warpmerge.write'):
+                    out = np.zeros((len(dst_bands), int(window.height), int(window.width)), dtype=dst_ds.dtypes[0])
+                    dst_ds.write(out, dst_bands, window=window)
+                continue
+            with profiling.stage('warpmerge.open'):
+                warped = [warpSource(filename) for filename in block_filenames]
+            with profiling.stage('warpmerge.merge'):
+                dest = mergeWindow(
+                    warped,
+                    dst_ds,
+                    window,
+                    indexes=src_bands,
                     resampling=resampling,
-                    )) for ds in dss]
-        src_dtype = dss[0].dtypes[0]
-        dst_dtype = dst_ds.dtypes[0]
-        for src_band, dst_band in zip(src_bands, dst_bands):
-            print(f'--       Warping band {src_band} into {dst_band}')
-            dest, _ = merge.merge(
-                warped,
-                bounds=dst_ds.bounds,
-                resampling=resampling,
-                indexes=[src_band],
-                dtype=np.float32,
-                **kwargs)
-            if (src_dtype != dst_dtype):
-                min_src = np.iinfo(src_dtype).min
-                max_src = np.iinfo(src_dtype).max
-                min_dst = np.iinfo(dst_dtype).min
-                max_dst = np.iinfo(dst_dtype).max
-                print(min_src,max_src,min_dst, max_dst)
-                print(np.histogram(dest))
-                dest = (np.maximum(dest,min_src) - min_src) / (max_src - min_src) * (max_dst - min_dst) + min_dst
-                print(np.histogram(dest))
-            dst_ds.write(dest[0], dst_band)
+                    **kwargs)
+            with profiling.stage('warpmerge.rescale'):
+                for idx, min_src, max_src, min_dst, max_dst in rescale_ranges:
+                    # in place, so that the block is the only temporary
+                    band = dest[idx]
+                    np.maximum(band, min_src, out=band)
+                    band -= min_src
+                    band *= (max_dst - min_dst) / (max_src - min_src)
+                    band += min_dst
+            with profiling.stage('warpmerge.write'):
+                dst_ds.write(dest, dst_bands, window=window)
     return dst_ds
 
+VRT_EXTENSION = "vrt"
+GDAL_TYPE_NAMES = {
+    'uint8': 'Byte',
+    'int8': 'Int8',
+    'uint16': 'UInt16',
+    'int16': 'Int16',
+    'uint32': 'UInt32',
+    'int32': 'Int32',
+    'float32': 'Float32',
+    'float64': 'Float64',
+    'int64': 'Int64',
+    'uint64': 'UInt64',
+    'float16': 'Float16',
+}
+# versions of gdal from which the types exist
+GDAL_TYPE_VERSIONS = dict(int64=(3, 5), uint64=(3, 5), float16=(3, 11))
+
+def gdalTypeNames():
+    gdal_version = tuple(int(part) for part in rio.__gdal_version__.split('.')[:2])
+    return {
+        name:type_name for name, type_name in GDAL_TYPE_NAMES.items()
+        if gdal_version >= GDAL_TYPE_VERSIONS.get(name, (0, 0))}
+
+def gdalTypeName(dtype):
+    name = np.dtype(dtype).name
+    type_names = gdalTypeNames()
+    if name not in type_names:
+        raise Exception(f"gdal {rio.__gdal_version__} cannot write {name} rasters to a vrt. "
+                        f"Valid dtypes are : {', '.join(type_names)}")
+    return type_names[name]
+
+def mapVrtBands(path, dst_bands):
+    # source band i goes to the band dst_bands[i - 1] as in warpmerge, the other bands stay empty
+    if dst_bands == list(range(1, len(dst_bands) + 1)):
+        return
+    tree = ElementTree.parse(path)
+    root = tree.getroot()
+    src_elements = root.findall('VRTRasterBand')
+    for element in src_elements:
+        root.remove(element)
+    mapped = {dst_band : element for dst_band, element in zip(dst_bands, src_elements)}
+    for band in range(1, max(dst_bands) + 1):
+        element = mapped.get(band)
+        if element is None:
+            element = ElementTree.Element('VRTRasterBand', dataType=src_elements[0].get('dataType'))
+        element.set('band', str(band))
+        root.append(element)
+    tree.write(path)
+
+def warpvrt(filenames, path, crs, bounds, width, height, dtype, bands=None, resampling=None):
+    # a mosaic of the sources, warped on the fly on the grid of the tile
+    resampling = Resampling.nearest if resampling is None else resampling
+    if isinstance(resampling, str):
+        resampling = str2Resampling(resampling)
+    dst_bands = [1] if bands is None else list(bands)
+    src_bands = range(1, len(dst_bands) + 1)
+    mosaic_path = f"{os.path.splitext(path)[0]}.sources.{VRT_EXTENSION}"
+    # the last listed source wins where they overlap, the finest sources come first as in warpmerge
+    result = gdal_buildvrt(
+        '-overwrite',
+        '-resolution', 'highest',
+        *(arg for band in src_bands for arg in ('-b', str(band))),
+        mosaic_path,
+        *map(os.path.abspath, reversed(filenames)))
+    if result.returncode:
+        raise Exception(f"gdalbuildvrt failed on {mosaic_path}")
+    mapVrtBands(mosaic_path, dst_bands)
+    result = gdal_warp(
+        '-overwrite',
+        '-of', 'VRT',
+        '-t_srs', crs.to_string(),
+        '-te', *map(str, bounds),
+        '-ts', str(width), str(height),
+        '-r', resampling.name.replace('_', ''),
+        '-ot', gdalTypeName(dtype),
+        mosaic_path,
+        path)
+    if result.returncode:
+        raise Exception(f"gdalwarp failed on {path}")
+    return path
+
 def warp_and_rasterize(src, dst_ds, bands=[1], where=None, getattribute=None, **rasterize_options):
-    features_list = list(utils.geo.readFeaturesFromShapeFile(
-            src,
-#            where=where,
-#            bounds=dst_ds.bounds,
-            crs=dst_ds.crs,
-            getattribute=getattribute))
+    with profiling.stage('rasterize.read'):
+        features_list = list(utils.geo.readFeaturesFromShapeFile(
+                src,
+#                where=where,
+#                bounds=dst_ds.bounds,
+                crs=dst_ds.crs,
+                getattribute=getattribute))
     print(features_list)    
     if 'default_value' in rasterize_options:
         rasterize_options['default_value'] = int(rasterize_options['default_value'])
     if 'fill' in rasterize_options:
         rasterize_options['fill'] = int(rasterize_options['fill'])
 
-    if not features_list:
-        out = np.zeros(dst_ds.shape, dtype=dst_ds.dtypes[0])
-    else:
-        out = features.rasterize(
-            features_list,
-            out_shape=dst_ds.shape,
-            transform=dst_ds.transform,
-            dtype=dst_ds.dtypes[0],
-            **rasterize_options
-        )
-    for band in bands:
-        dst_ds.write(out, band)
+    with profiling.stage('rasterize.burn'):
+        if not features_list:
+            out = np.zeros(dst_ds.shape, dtype=dst_ds.dtypes[0])
+        else:
+            out = features.rasterize(
+                features_list,
+                out_shape=dst_ds.shape,
+                transform=dst_ds.transform,
+                dtype=dst_ds.dtypes[0],
+                **rasterize_options
+            )
+    with profiling.stage('rasterize.write'):
+        for band in bands:
+            dst_ds.write(out, band)
     return dst_ds
 
 def allowedextension(mode):